@@ -1,8 +1,27 @@
 #!/usr/bin/env python
 import libtcodpy as tcod
+import tcod.random as tcod_random # The random streams use it directly, without libtcodpy's deprecation wrappers
+import argparse
+import array
+import collections
+import concurrent.futures
+import hashlib
+import heapq
+import io
+import multiprocessing
+import json
 import math
+import mmap
+import os
+import random
 import textwrap
 import shelve
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
 
 FULLSCREEN = False
 SCREEN_WIDTH = 80
@@ -17,6 +36,7 @@ PANEL_Y = SCREEN_HEIGHT - PANEL_HEIGHT
 MSG_X = BAR_WIDTH + 2
 MSG_WIDTH = SCREEN_WIDTH - BAR_WIDTH - 2
 MSG_HEIGHT = PANEL_HEIGHT - 1
+MESSAGE_LOG_SIZE = 5000 # Messages kept for the message log screen ('m'), the oldest are dropped
 
 LEVEL_SCREEN_WIDTH = 40
 CHARACTER_SCREEN_WIDTH = 30
@@ -30,12 +50,33 @@ ROOM_MIN_SIZE = 6
 MAX_ROOMS = 30
 
 TURN_BASED = True
+REALTIME_TURN = 0.5 # Seconds per turn when TURN_BASED is off: a player who does nothing for that long waits
 TRADITIONAL_LOOK = False
 SHOW_ROOM_NUMBERS = False
+ROOM_LABELS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789' # Used in turn, then again from the start
+
+PROFILE_SAMPLES = 1000 # Timings kept per phase for the profiler's percentiles (a rolling window)
+PROFILE_TRACE_EVENTS = 1000000 # The most recent timings kept for --trace
+PROFILE_OVERLAY_INTERVAL = 0.5 # Seconds between updates of the profiler overlay (F3)
+
+# Map sizes for --benchmark-mapgen. Each gets MAX_ROOMS rooms per MAP_WIDTH * MAP_HEIGHT tiles
+MAPGEN_BENCHMARK_SIZES = ((80, 43), (250, 250), (500, 500), (1000, 1000), (2000, 2000))
 
 FOV_ALGO = 0
 FOV_LIGHT_WALLS = True
 TORCH_RADIUS = 10
+FOV_CACHE_SIZE = 64 # FOV results remembered per level, see update_fov
+CHASE_DISTANCE = 20 # How many steps away from the player monsters can find their way, see DistanceField
+NORMAL_SPEED = 100 # A monster of speed 100 acts once per player turn, 200 twice, 50 every other turn
+TURN_TIME = 100 # Game time of one player turn, see Scheduler
+WAKE_RADIUS = 20 # Monsters out of sight and further than this from the player sleep until woken (None: never)
+DORMANT_BUCKET_SIZE = 16 # Sleeping monsters are bucketed by square areas this wide, see DormantActors
+ACTOR_AWAKE = 1 # States of a row of entities.actors: in its level's Scheduler, or asleep (0: neither)
+ACTOR_ASLEEP = 2
+NOISE_ALERT_TURNS = 10 # Turns a monster woken by a noise stays awake, even far from the player
+ATTACK_NOISE = 8 # How far the noise of a fight carries
+LIGHTNING_NOISE = 15
+FIREBALL_NOISE = 15
 
 HEAL_AMOUNT = 16
 LIGHTNING_RANGE = 5
@@ -43,16 +84,35 @@ LIGHTNING_DAMAGE = 40
 CONFUSE_NUM_TURNS = 10
 CONFUSE_RANGE = 10
 FIREBALL_RADIUS = 3
+CONE_ANGLE = 90 # Degrees covered by a cone-shaped area effect, see cone_stencil
 FIREBALL_DAMAGE = 25
 
 # Experience and level-ups
 LEVEL_UP_BASE = 200
 LEVEL_UP_FACTOR = 150
 
-tcod.sys_set_fps(LIMIT_FPS)
-
-con = tcod.console_new(MAP_WIDTH, MAP_HEIGHT)
-panel = tcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
+# Independent random streams: map layout, monster spawns, item drops and monster AI
+RNG_STREAMS = ('map', 'spawn', 'loot', 'ai')
+REPLAY_VERSION = 1
+
+# Save files. The shelve file is the format used before SAVE_VERSION 1, and is still read
+SAVE_FILE = 'savegame.sav'
+LEGACY_SAVE_FILE = 'savegame'
+SAVE_MAGIC = b'FRSV'
+SAVE_VERSION = 5 # 2: up stairs and the levels kept by LevelStore. 3: the message log. 4: monster speeds.
+                 # 5: the generation of each level file
+AUTOSAVE_INTERVAL = 50 # Turns between autosaves
+PREGENERATE_LEVELS = True # Generate the next level in a worker process while the current one is played
+LEVEL_DIR = 'levels' # Where levels the player has left are written once they no longer fit in memory
+LEVEL_MEMORY_BUDGET = 1024 * 1024 # Roughly how many bytes of visited levels to keep in memory, see LevelStore
+LEVEL_OBJECT_SIZE = 400 # Roughly the memory used by one object with its components and index entry, see --memory-report
+
+# World mode: new games are one huge level of WORLD_SIZE (width, height) tiles, kept in a memory-mapped
+# file and played through the chunks around the player (see World). None for normal levels
+WORLD_SIZE = None
+WORLD_CHUNK_SIZE = 64 # Tiles along each side of a chunk; 64 makes each chunk exactly three 4 KiB pages
+WORLD_REGION_CHUNKS = 3 # Chunks along each side of the region in memory, with the player in the middle one
+WORLD_SPAWN_BATCH = 2000 # While a world is generated, its objects are packed away whenever this many are in memory
 
 colour_dark_wall = tcod.Color(0, 30, 0)
 colour_dark_ground = tcod.Color(20, 60, 20)
@@ -60,14 +120,131 @@ colour_light_wall = tcod.Color(130, 110, 50)
 colour_light_ground = tcod.Color(200, 180, 50)
 
 
+def state_dict(state):
+    # Pickled state as a dict: classes with __slots__ may get a (__dict__, slots) pair, and saves from
+    # before __slots__ a plain __dict__
+    if isinstance(state, tuple):
+        return dict(state[0] or {}, **(state[1] or {}))
+    return dict(state)
+
+
+def slot_state(obj):
+    # __getstate__ for classes with __slots__: every slot that is set, as a dict
+    state = {}
+    for cls in type(obj).__mro__:
+        for name in getattr(cls, '__slots__', ()):
+            if hasattr(obj, name):
+                state[name] = getattr(obj, name)
+    return state
+
+
+def restore_slots(obj, state):
+    # __setstate__ for classes with __slots__, see state_dict
+    for (name, value) in state_dict(state).items():
+        setattr(obj, name, value)
+
+
+class ComponentTable:
+    # Dense columns of numbers for one kind of component: row i of every column belongs to the same
+    # component, and views[i] is the object that reads and writes them (None if the row is free). Rows
+    # are released explicitly when their component leaves the game, and reused
+    def __init__(self, *columns):
+        self.columns = columns
+        for name in columns:
+            setattr(self, name, array.array('i'))
+        self.views = []
+        self.free = []
+
+    def allocate(self, view, *values):
+        # Give view a row, with values for the first columns and 0 in the others
+        values += (0,) * (len(self.columns) - len(values))
+        if self.free:
+            row = self.free.pop()
+            for (name, value) in zip(self.columns, values):
+                getattr(self, name)[row] = value
+            self.views[row] = view
+            return row
+        for (name, value) in zip(self.columns, values):
+            getattr(self, name).append(value)
+        self.views.append(view)
+        return len(self.views) - 1
+
+    def owns(self, view, row):
+        # False once view's row was released, or if the store was replaced since (a new game)
+        return row is not None and row < len(self.views) and self.views[row] is view
+
+    def release(self, view, row):
+        if self.owns(view, row):
+            self.views[row] = None
+            self.free.append(row)
+
+    def live(self):
+        return len(self.views) - len(self.free)
+
+
+class EntityStore:
+    # Struct-of-arrays storage for the numbers of every entity. An entity ID is a row of the position table;
+    # fighter stats and the AI state the Scheduler uses have tables of their own, whose eid column leads
+    # back to the position. Object and Fighter are thin views over their rows, so game code still reads
+    # obj.x or fighter.hp, and pickling them writes the values rather than the rows
+    def __init__(self):
+        self.positions = ComponentTable('x', 'y')
+        self.fighters = ComponentTable('eid', 'hp', 'base_max_hp', 'base_defense', 'base_power', 'xp',
+                                       'power_bonus', 'defense_bonus', 'max_hp_bonus')
+        self.actors = ComponentTable('eid', 'speed', 'order', 'ticket', 'state', 'alert_until')
+
+    def report(self):
+        tables = (self.positions, self.fighters, self.actors)
+        size = sum(getattr(table, name).itemsize * len(table.views) for table in tables for name in table.columns)
+        return 'Entities: %d alive (%d rows), %d fighters (%d rows), %d actors (%d rows), columns %d bytes' % (
+            self.positions.live(), len(self.positions.views), self.fighters.live(), len(self.fighters.views),
+            self.actors.live(), len(self.actors.views), size)
+
+
+class Column:
+    # An attribute of a view class (Fighter) that is stored in a ComponentTable column, at the view's row
+    def __init__(self, table, name):
+        self.table = table
+        self.name = name
+
+    def __get__(self, view, owner=None):
+        if view is None:
+            return self
+        return getattr(getattr(entities, self.table), self.name)[view.row]
+
+    def __set__(self, view, value):
+        getattr(getattr(entities, self.table), self.name)[view.row] = value
+
+
+def release_entity(obj):
+    # Free the rows of an object leaving the game for good: used up, written to a level file or packed
+    # away. It mustn't be used afterwards (its rows are None, so reading its position fails)
+    if not entities.positions.owns(obj, obj.eid):
+        return
+    if obj.fighter:
+        obj.fighter.release()
+    obj.ai = None
+    entities.positions.release(obj, obj.eid)
+    obj.eid = None
+
+
 class Equipment:
     # An object that can be equipped, yielding bonuses. Automatically adds the Item component.
+    __slots__ = ('power_bonus', 'defense_bonus', 'max_hp_bonus', 'slot', 'is_equipped', 'wearer', 'owner')
+    __getstate__ = slot_state
+
     def __init__(self, slot, power_bonus=0, defense_bonus=0, max_hp_bonus=0):
         self.power_bonus = power_bonus
         self.defense_bonus = defense_bonus
         self.max_hp_bonus = max_hp_bonus
         self.slot = slot
         self.is_equipped = False
+        self.wearer = None # The object (player or monster) wearing it
+
+    def __setstate__(self, state):
+        # Saves from before bonuses were cached on Fighter don't record the wearer, see load_game
+        self.wearer = None
+        restore_slots(self, state)
 
     def toggle_equip(self): # Toggle equip/dequip status
         if self.is_equipped:
@@ -75,40 +252,56 @@ class Equipment:
         else:
             self.equip()
 
-    def equip(self):
+    def equip(self, wearer=None):
+        # Equip on the player, unless another wearer (e.g. a monster) is given
+        if wearer is None:
+            wearer = player
         # If the slot is already being used, dequip whatever is in there first
-        old_equipment = get_equipped_in_slot(self.slot)
+        old_equipment = get_equipped_in_slot(self.slot, wearer)
         if old_equipment is not None:
             old_equipment.dequip()
         # Equip object and show a message about it
         self.is_equipped = True
-        add_message('Equipped ' + self.owner.name + ' on ' + self.slot + '.', tcod.light_green)
+        self.wearer = wearer
+        wearer.fighter.add_equipment(self)
+        if wearer == player:
+            add_message('Equipped %s on %s.', tcod.light_green, (self.owner.name, self.slot))
 
     def dequip(self):
         # Dequip object and show a message about it
         if not self.is_equipped: return
         self.is_equipped = False
-        add_message('Dequipped ' + self.owner.name + ' from ' + self.slot + '.', tcod.light_yellow)
+        wearer = self.wearer
+        self.wearer = None
+        if wearer.fighter:
+            wearer.fighter.remove_equipment(self)
+        if wearer == player:
+            add_message('Dequipped %s from %s.', tcod.light_yellow, (self.owner.name, self.slot))
 
 
 class Item:
     # An item that can be picked up and used
+    __slots__ = ('use_function', 'owner')
+    __getstate__ = slot_state
+    __setstate__ = restore_slots
+
     def __init__(self, use_function=None):
         self.use_function = use_function
 
     def pick_up(self):
         # Add to the player's inventory and remove from the map
         if len(inventory) >= 26:
-            add_message('Your inventory is full, cannot pick up ' + self.owner.name + '.', tcod.yellow)
+            add_message('Your inventory is full, cannot pick up %s.', tcod.yellow, (self.owner.name,))
         else:
             inventory.append(self.owner)
             objects.remove(self.owner)
-            add_message('A ' + self.owner.name + ' picked up.', tcod.green)
+            self.owner.clear()
+            add_message('A %s picked up.', tcod.green, (self.owner.name,))
 
-        # Automatically equip object if slot empty
-        equipment = self.owner.equipment
-        if equipment and get_equipped_in_slot(equipment.slot) is None:
-            equipment.equip()
+            # Automatically equip object if slot empty
+            equipment = self.owner.equipment
+            if equipment and get_equipped_in_slot(equipment.slot) is None:
+                equipment.equip()
 
     def use(self):
         # Special case: if the object has the Equipment component, the 'use' action is to equip/dequip
@@ -117,10 +310,11 @@ class Item:
             return
         # Just call the "use_function" if it is defined
         if self.use_function is None:
-            add_message('The ' + self.owner.name + ' cannot be used.')
+            add_message('The %s cannot be used.', tcod.white, (self.owner.name,))
         else:
             if self.use_function() != 'cancelled':
                 inventory.remove(self.owner) # destroy after use, unless it was cancelled for some reason
+                release_entity(self.owner)
 
     def drop(self):
         # If the object has the equipment component, dequip it before dropping
@@ -132,33 +326,84 @@ class Item:
         inventory.remove(self.owner)
         self.owner.x = player.x
         self.owner.y = player.y
-        add_message('You drop a ' + self.owner.name + '.', tcod.yellow)
+        add_message('You drop a %s.', tcod.yellow, (self.owner.name,))
 
 
 class Fighter:
-    # Combat-related properties and methods (monster, player, NPC)
+    # Combat-related properties and methods (monster, player, NPC). The stats are kept in entities.fighters
+    eid = Column('fighters', 'eid')
+    hp = Column('fighters', 'hp')
+    base_max_hp = Column('fighters', 'base_max_hp')
+    base_defense = Column('fighters', 'base_defense')
+    base_power = Column('fighters', 'base_power')
+    xp = Column('fighters', 'xp')
+    power_bonus = Column('fighters', 'power_bonus')
+    defense_bonus = Column('fighters', 'defense_bonus')
+    max_hp_bonus = Column('fighters', 'max_hp_bonus')
+    __slots__ = ('row', 'death_function', 'equipped')
+
     def __init__(self, hp, defense, power, xp, death_function=None):
-        self.base_max_hp = hp
-        self.hp = hp
-        self.base_defense = defense
-        self.base_power = power
-        self.xp = xp
+        self.row = entities.fighters.allocate(self, -1, hp, hp, defense, power, xp)
         self.death_function = death_function
 
+        # What is worn in each slot (None until something is, as most monsters wear nothing). The bonuses it
+        # all adds up to are kept up to date by Equipment
+        self.equipped = None
+
+    def __getstate__(self):
+        # The stats as plain values, the row is only valid in this process. The owner sets itself again
+        state = {'death_function': self.death_function, 'equipped': self.equipped}
+        for name in entities.fighters.columns[1:]:
+            state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        # Saves from before bonuses were cached start with nothing equipped, see load_game. Older saves also
+        # stored the owner, which Object.__setstate__ sets anyway
+        state = state_dict(state)
+        state.setdefault('equipped', None)
+        self.row = entities.fighters.allocate(self, -1, *[state.pop(name, 0) for name in entities.fighters.columns[1:]])
+        self.death_function = state.get('death_function')
+        self.equipped = state['equipped']
+
     @property
-    def power(self): # Return actual power by summing up the bonuses from all equipped items
-        bonus = sum(equipment.power_bonus for equipment in get_all_equipped(self.owner))
-        return self.base_power + bonus
+    def owner(self):
+        eid = self.eid
+        return entities.positions.views[eid] if eid >= 0 else None
+
+    @owner.setter
+    def owner(self, obj):
+        self.eid = obj.eid
+
+    def release(self):
+        entities.fighters.release(self, self.row)
+        self.row = None
+
+    @property
+    def power(self): # Return actual power, base plus the bonuses from all equipped items
+        return self.base_power + self.power_bonus
 
     @property
-    def defense(self): # return actual defence, by summing up bonuses from euipment
-        bonus = sum(equipment.defense_bonus for equipment in get_all_equipped(self.owner))
-        return self.base_defense + bonus
+    def defense(self): # return actual defence, base plus bonuses from euipment
+        return self.base_defense + self.defense_bonus
 
     @property
-    def max_hp(self): # Return actual max hp, by summing up the bonuses from all equipped items
-        bonus = sum(equipment.max_hp_bonus for equipment in get_all_equipped(self.owner))
-        return self.base_max_hp + bonus
+    def max_hp(self): # Return actual max hp, base plus the bonuses from all equipped items
+        return self.base_max_hp + self.max_hp_bonus
+
+    def add_equipment(self, equipment):
+        if self.equipped is None:
+            self.equipped = {}
+        self.equipped[equipment.slot] = equipment
+        self.power_bonus += equipment.power_bonus
+        self.defense_bonus += equipment.defense_bonus
+        self.max_hp_bonus += equipment.max_hp_bonus
+
+    def remove_equipment(self, equipment):
+        del self.equipped[equipment.slot]
+        self.power_bonus -= equipment.power_bonus
+        self.defense_bonus -= equipment.defense_bonus
+        self.max_hp_bonus -= equipment.max_hp_bonus
 
     def take_damage(self, damage):
         # Apply damage if possible
@@ -166,23 +411,25 @@ class Fighter:
             self.hp -= damage
             # Check for death, if there is a death function, call it
             if self.hp <= 0:
+                (owner, xp) = (self.owner, self.xp) # The death function may release this Fighter
                 function = self.death_function
                 if function is not None:
-                    function(self.owner)
+                    function(owner)
 
-                if self.owner != player: # yield experience to the player
-                    player.fighter.xp += self.xp
+                if owner != player: # yield experience to the player
+                    player.fighter.xp += xp
 
     def attack(self, target):
         # A simple formula for attack damage
         damage = self.power - target.fighter.defense
 
+        make_noise(target.x, target.y, ATTACK_NOISE)
         if damage > 0:
             # Make the target take some damage
-            add_message(self.owner.name.capitalize() + ' attacks ' + target.name + ' for ' + str(damage) + ' hit points.', tcod.grey)
+            add_message('%s attacks %s for %d hit points.', tcod.grey, (self.owner.name.capitalize(), target.name, damage))
             target.fighter.take_damage(damage)
         else:
-            add_message(self.owner.name.capitalize() + ' attacks ' + target.name + ' but it has no effect.', tcod.grey)
+            add_message('%s attacks %s but it has no effect.', tcod.grey, (self.owner.name.capitalize(), target.name))
 
     def heal(self, amount):
         # Heal by the given amount
@@ -193,13 +440,30 @@ class Fighter:
 
 class BasicMonster:
     # AI for a basic monster
+    __slots__ = ('owner', 'speed')
+    __getstate__ = slot_state
+
+    def __init__(self, speed=NORMAL_SPEED):
+        self.speed = speed
+
+    def __setstate__(self, state):
+        # Monsters pickled before speeds existed move at normal speed
+        state = state_dict(state)
+        state.setdefault('speed', NORMAL_SPEED)
+        restore_slots(self, state)
+
     def take_turn(self):
         # A basic monster takes its turn. If PC can see it, it can see PC
         monster = self.owner
-        if tcod.map_is_in_fov(fov_map, monster.x, monster.y):
-            # Move towards PC if far away
-            if monster.distance_to(player) >= 2:
+        if is_in_fov(monster.x, monster.y):
+            field = player_distance_field()
+            distance = field.distance(monster.x, monster.y)
+            if distance is None:
+                # Too far to walk to within CHASE_DISTANCE: just head in the player's direction
                 monster.move_towards(player.x, player.y)
+            # Move towards PC if far away, going round walls by following the distance field
+            elif distance >= 2:
+                field.step(monster)
             # If close enough, attack if player is still alive
             elif player.fighter.hp > 0:
                 monster.fighter.attack(player)
@@ -207,23 +471,36 @@ class BasicMonster:
 
 class ConfusedMonster:
     # AI for a temporarily confused monster
+    __slots__ = ('old_ai', 'num_turns', 'owner')
+    __getstate__ = slot_state
+    __setstate__ = restore_slots
+
     def __init__(self, old_ai, num_turns=CONFUSE_NUM_TURNS):
         self.old_ai = old_ai
         self.num_turns = num_turns
 
+    @property
+    def speed(self):
+        # A confused monster stumbles around as fast as it normally moves
+        return self.old_ai.speed
+
     def take_turn(self):
         if self.num_turns > 0:
             # Move randomly
-            self.owner.move(tcod.random_get_int(0, -1, 1), tcod.random_get_int(0, -1, 1))
+            self.owner.move(rngs['ai'].randint(-1, 1), rngs['ai'].randint(-1, 1))
             self.num_turns -= 1
 
         else: # Restore the previous AI and delete this AI
             self.owner.ai = self.old_ai
-            add_message('The ' + self.owner.name + ' is no longer confused!', tcod.orange)
+            add_message('The %s is no longer confused!', tcod.orange, (self.owner.name,))
 
 
 class Rect:
     # A rectangle on the map, used to characterise a room
+    __slots__ = ('x1', 'y1', 'x2', 'y2')
+    __getstate__ = slot_state
+    __setstate__ = restore_slots
+
     def __init__(self, x, y, w, h):
         self.x1 = x
         self.y1 = y
@@ -241,8 +518,39 @@ class Rect:
                self.y1 <= other.y2 and self.y2 >= other.y1)
 
 
+class RoomIndex:
+    # The rooms placed so far, bucketed by the grid cells they overlap, so a new room is only tested against
+    # the rooms near it instead of all of them. With cells bigger than a room, a room is in at most four
+    def __init__(self, cell_size=ROOM_MAX_SIZE + 1):
+        self.cell_size = cell_size
+        self.buckets = {}
+
+    def add(self, rect):
+        size = self.cell_size
+        for cell_y in range(rect.y1 // size, rect.y2 // size + 1):
+            for cell_x in range(rect.x1 // size, rect.x2 // size + 1):
+                self.buckets.setdefault((cell_x, cell_y), []).append(rect)
+
+    def intersects(self, rect):
+        # Returns true if rect intersects with any room in the index. Rooms that intersect share a tile,
+        # so they share the bucket of that tile. This runs for every room tried, so Rect.intersect is inlined
+        size = self.cell_size
+        (x1, y1, x2, y2) = (rect.x1, rect.y1, rect.x2, rect.y2)
+        for cell_y in range(y1 // size, y2 // size + 1):
+            for cell_x in range(x1 // size, x2 // size + 1):
+                for other in self.buckets.get((cell_x, cell_y), ()):
+                    if x1 <= other.x2 and x2 >= other.x1 and y1 <= other.y2 and y2 >= other.y1:
+                        return True
+        return False
+
+
 class Tile:
-    # A tile of the map and its properties
+    # A tile of the map and its properties. The map itself no longer stores Tile objects (see Map),
+    # this class is only kept so that saves made with the old list-of-lists map can still be loaded
+    __slots__ = ('explored', 'blocked', 'block_sight')
+    __getstate__ = slot_state
+    __setstate__ = restore_slots
+
     def __init__(self, blocked, block_sight=None):
         self.explored = False
         self.blocked = blocked
@@ -252,15 +560,236 @@ class Tile:
         self.block_sight = block_sight
 
 
+def _and_planes(a, b):
+    # Bitwise AND of two equally sized byte planes, done on big integers so the loop runs in C
+    return (int.from_bytes(a, 'little') & int.from_bytes(b, 'little')).to_bytes(len(a), 'little')
+
+
+def _or_planes(a, b):
+    # Bitwise OR of two equally sized byte planes
+    return (int.from_bytes(a, 'little') | int.from_bytes(b, 'little')).to_bytes(len(a), 'little')
+
+
+def _tile_classes(wall, visible, explored):
+    # Combine three 0/1 byte planes into one plane of tile classes (wall + 2 * visible + 4 * explored).
+    # Every byte stays below 8, so shifting the whole integer never carries into the next tile
+    total = (int.from_bytes(wall, 'little') | int.from_bytes(visible, 'little') << 1 |
+             int.from_bytes(explored, 'little') << 2)
+    return total.to_bytes(len(wall), 'little')
+
+
+class Map:
+    # The dungeon map. Instead of one Tile object per cell, each tile property is a flat byte plane
+    # (one byte per tile, row-major, index = y * width + x), so rooms and tunnels can be carved with
+    # slice assignment and the planes can be handed over to FOV and rendering as they are
+    def __init__(self, width, height, blocked=True):
+        self.width = width
+        self.height = height
+        fill = bytes([1 if blocked else 0])
+        self.blocked = bytearray(fill * (width * height))
+        self.block_sight = bytearray(fill * (width * height))
+        self.explored = bytearray(width * height)
+        self.revision = 0 # Bumped whenever blocked or block_sight change, so cached FOV can be invalidated
+
+    @classmethod
+    def from_tiles(cls, tiles):
+        # Build a Map from the old map[x][y] list of Tile objects (used when loading old saves)
+        width, height = len(tiles), len(tiles[0])
+        new_map = cls(width, height)
+        for x in range(width):
+            for y in range(height):
+                i = y * width + x
+                new_map.blocked[i] = bool(tiles[x][y].blocked)
+                new_map.block_sight[i] = bool(tiles[x][y].block_sight)
+                new_map.explored[i] = bool(tiles[x][y].explored)
+        return new_map
+
+    def index(self, x, y):
+        return y * self.width + x
+
+    def is_blocked(self, x, y):
+        return self.blocked[y * self.width + x]
+
+    def blocks_sight(self, x, y):
+        return self.block_sight[y * self.width + x]
+
+    def is_explored(self, x, y):
+        return self.explored[y * self.width + x]
+
+    def set_tile(self, x, y, blocked, block_sight=None):
+        # Change a single tile, e.g. to open or close a door. By default a blocked tile also blocks sight
+        i = y * self.width + x
+        self.blocked[i] = bool(blocked)
+        self.block_sight[i] = bool(blocked if block_sight is None else block_sight)
+        self.revision += 1
+
+    def carve(self, x1, y1, x2, y2):
+        # Make every tile between (x1, y1) and (x2, y2) inclusive passable, one row slice at a time
+        self.revision += 1
+        run = bytes(x2 - x1 + 1)
+        for y in range(y1, y2 + 1):
+            start = y * self.width + x1
+            self.blocked[start:start + len(run)] = run
+            self.block_sight[start:start + len(run)] = run
+
+    def carve_h(self, x1, x2, y):
+        # A horizontal tunnel is a single contiguous slice of each plane
+        self.carve(min(x1, x2), y, max(x1, x2), y)
+
+    def carve_v(self, y1, y2, x):
+        # A vertical tunnel is a strided slice (one tile per row) of each plane
+        start = min(y1, y2) * self.width + x
+        stop = max(y1, y2) * self.width + x + 1
+        run = bytes(abs(y2 - y1) + 1)
+        self.revision += 1
+        self.blocked[start:stop:self.width] = run
+        self.block_sight[start:stop:self.width] = run
+
+    def open_cells(self):
+        # Yield (x, y, transparent, walkable) for every tile that is not solid rock.
+        # Solid tiles are skipped with bytes.find, so carving-sized work is done in Python, not map-sized
+        solid = _and_planes(self.blocked, self.block_sight)
+        i = solid.find(0)
+        while i != -1:
+            yield i % self.width, i // self.width, not self.block_sight[i], not self.blocked[i]
+            i = solid.find(0, i + 1)
+
+
+_FLIP_BITS = bytes.maketrans(b'\x00\x01', b'\x01\x00')
+
+
+class ChunkedMap:
+    # The map of a world, too big to keep in memory: the same three planes as Map, stored chunk by chunk in a
+    # memory-mapped scratch file. A chunk is WORLD_CHUNK_SIZE tiles square and holds its three planes one
+    # after the other, so its tiles are a few whole pages that the OS reads in when touched and page_out
+    # gives back. The file stores walkable and transparent rather than blocked and block_sight, so that a
+    # new (sparse, all zero) file is solid rock and the parts never carved take no disk space either
+    def __init__(self, width, height):
+        size = WORLD_CHUNK_SIZE
+        self.width = width
+        self.height = height
+        self.chunks_x = -(-width // size)
+        self.chunks_y = -(-height // size)
+        self.plane_size = size * size
+        self.chunk_bytes = 3 * self.plane_size
+        self.file = tempfile.TemporaryFile()
+        self.file.truncate(self.chunks_x * self.chunks_y * self.chunk_bytes)
+        self.data = mmap.mmap(self.file.fileno(), 0)
+        self.revision = 0
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def chunk_at(self, x, y):
+        return (x // WORLD_CHUNK_SIZE, y // WORLD_CHUNK_SIZE)
+
+    def offset(self, x, y):
+        # Where tile (x, y) of the first plane is in the file: its chunk, then its row and column in the chunk
+        (chunk_x, local_x) = divmod(x, WORLD_CHUNK_SIZE)
+        (chunk_y, local_y) = divmod(y, WORLD_CHUNK_SIZE)
+        return (chunk_y * self.chunks_x + chunk_x) * self.chunk_bytes + local_y * WORLD_CHUNK_SIZE + local_x
+
+    def is_blocked(self, x, y):
+        return not self.data[self.offset(x, y)]
+
+    def blocks_sight(self, x, y):
+        return not self.data[self.offset(x, y) + self.plane_size]
+
+    def is_explored(self, x, y):
+        return self.data[self.offset(x, y) + 2 * self.plane_size]
+
+    def set_tile(self, x, y, blocked, block_sight=None):
+        i = self.offset(x, y)
+        self.data[i] = not blocked
+        self.data[i + self.plane_size] = not (blocked if block_sight is None else block_sight)
+        self.revision += 1
+
+    def carve(self, x1, y1, x2, y2):
+        # Like Map.carve, one slice per row of each chunk the rectangle crosses
+        self.revision += 1
+        size = WORLD_CHUNK_SIZE
+        for y in range(y1, y2 + 1):
+            x = x1
+            while x <= x2:
+                end = min(x2, (x // size + 1) * size - 1) # Last tile of the row in this chunk
+                start = self.offset(x, y)
+                run = b'\x01' * (end - x + 1)
+                self.data[start:start + len(run)] = run
+                self.data[start + self.plane_size:start + self.plane_size + len(run)] = run
+                x = end + 1
+
+    def carve_h(self, x1, x2, y):
+        self.carve(min(x1, x2), y, max(x1, x2), y)
+
+    def carve_v(self, y1, y2, x):
+        # One strided slice per chunk the tunnel crosses
+        self.revision += 1
+        size = WORLD_CHUNK_SIZE
+        (y, last) = (min(y1, y2), max(y1, y2))
+        while y <= last:
+            end = min(last, (y // size + 1) * size - 1)
+            start = self.offset(x, y)
+            stop = start + (end - y) * size + 1
+            run = b'\x01' * (end - y + 1)
+            self.data[start:stop:size] = run
+            self.data[start + self.plane_size:stop + self.plane_size:size] = run
+            y = end + 1
+
+    def read_region(self, x0, y0, width, height):
+        # Copy a chunk-aligned rectangle into an ordinary Map, whose (0, 0) is (x0, y0) here
+        size = WORLD_CHUNK_SIZE
+        planes = [bytearray(width * height) for i in range(3)]
+        for y in range(height):
+            for x in range(0, width, size):
+                start = self.offset(x0 + x, y0 + y)
+                for (i, plane) in enumerate(planes):
+                    plane_start = start + i * self.plane_size
+                    plane[y * width + x:y * width + x + size] = self.data[plane_start:plane_start + size]
+        region = Map(width, height)
+        region.blocked = bytearray(planes[0].translate(_FLIP_BITS))
+        region.block_sight = bytearray(planes[1].translate(_FLIP_BITS))
+        region.explored = planes[2]
+        return region
+
+    def write_region(self, region, x0, y0):
+        # The reverse of read_region, to keep what changed in the region (explored tiles, terrain)
+        size = WORLD_CHUNK_SIZE
+        width = region.width
+        planes = (region.blocked.translate(_FLIP_BITS), region.block_sight.translate(_FLIP_BITS), region.explored)
+        for y in range(region.height):
+            for x in range(0, width, size):
+                start = self.offset(x0 + x, y0 + y)
+                for (i, plane) in enumerate(planes):
+                    plane_start = start + i * self.plane_size
+                    self.data[plane_start:plane_start + size] = plane[y * width + x:y * width + x + size]
+
+    def page_out(self, chunks=None):
+        # Tell the OS it can drop the pages of these chunks (all of them by default) from memory. The file
+        # keeps their contents and they are read back in if touched again
+        if not hasattr(mmap, 'MADV_DONTNEED'):
+            return
+        if chunks is None:
+            self.data.madvise(mmap.MADV_DONTNEED)
+            return
+        for (chunk_x, chunk_y) in chunks:
+            self.data.madvise(mmap.MADV_DONTNEED, (chunk_y * self.chunks_x + chunk_x) * self.chunk_bytes,
+                              self.chunk_bytes)
+
+
 class Object:
     # This is a generic object: the player, a monster, an item, the toilet...
-    # It's always represented by a character on the screen
+    # It's always represented by a character on the screen. The position is kept in entities.positions, at
+    # the row that is the object's entity ID, and an object with an AI has a row of entities.actors
+    __slots__ = ('always_visible', 'name', 'blocks', 'eid', 'container', 'char', 'colour', 'fighter', 'item', '_ai',
+                 'actor', 'equipment', 'level') # level is only set on the player
+
     def __init__(self, x, y, char, name, colour, blocks=False, always_visible=False, fighter=None, ai=None, item=None, equipment=None):
         self.always_visible = always_visible
         self.name = name
         self.blocks = blocks
-        self.x = x
-        self.y = y
+        self.eid = entities.positions.allocate(self, x, y)
+        self.container = None # The ObjectList indexing this object, if it is on the map
         self.char = char
         self.colour = colour
         self.fighter = fighter
@@ -271,6 +800,7 @@ class Object:
         if self.item:
             self.item.owner = self
 
+        (self._ai, self.actor) = (None, None)
         self.ai = ai
         if self.ai:
             self.ai.owner = self
@@ -281,11 +811,97 @@ class Object:
             self.item = Item()
             self.item.owner = self
 
+    def __getstate__(self):
+        # The spatial index is rebuilt when the ObjectList is loaded, so don't save the back-reference.
+        # The position is saved as plain x and y, the rows are only valid in this process
+        state = slot_state(self)
+        for name in ('eid', 'actor', '_ai', 'container'):
+            state.pop(name, None)
+        (state['x'], state['y'], state['ai']) = (self.x, self.y, self.ai)
+        return state
+
+    def __setstate__(self, state):
+        # Saves from before the entity store stored the position as _x and _y (or older ones, x and y)
+        state = state_dict(state)
+        if '_x' in state:
+            state['x'] = state.pop('_x')
+            state['y'] = state.pop('_y')
+        self.eid = entities.positions.allocate(self, state.pop('x'), state.pop('y'))
+        ai = state.pop('_ai', state.pop('ai', None))
+        state.setdefault('container', None)
+        restore_slots(self, state)
+        (self._ai, self.actor) = (None, None)
+        self.ai = ai
+        if self.fighter:
+            self.fighter.owner = self
+
+    @property
+    def x(self):
+        return entities.positions.x[self.eid]
+
+    @x.setter
+    def x(self, value):
+        # Moving an object changes what has to be drawn on both its old and new tile
+        positions = entities.positions
+        (x, y) = (positions.x[self.eid], positions.y[self.eid])
+        mark_dirty(x, y)
+        if self.container is not None:
+            self.container.relocate(self, value, y)
+        positions.x[self.eid] = value
+        mark_dirty(value, y)
+
+    @property
+    def y(self):
+        return entities.positions.y[self.eid]
+
+    @y.setter
+    def y(self, value):
+        positions = entities.positions
+        (x, y) = (positions.x[self.eid], positions.y[self.eid])
+        mark_dirty(x, y)
+        if self.container is not None:
+            self.container.relocate(self, x, value)
+        positions.y[self.eid] = value
+        mark_dirty(x, value)
+
+    def place(self, x, y):
+        # Set the position without telling the ObjectList or the screen, for code that rebuilds both
+        entities.positions.x[self.eid] = x
+        entities.positions.y[self.eid] = y
+
+    @property
+    def ai(self):
+        return self._ai
+
+    @ai.setter
+    def ai(self, value):
+        # Gaining or losing an AI adds or removes the object from its level's Scheduler, and gives it a row of
+        # entities.actors or releases it. An AI replacing another (confusion) keeps the row, so its place
+        actors = entities.actors
+        container = self.container
+        if value is None:
+            if container is not None:
+                container.scheduler.remove(self)
+                container.dormant.remove(self)
+            actors.release(self, self.actor)
+            self.actor = None
+        else:
+            if self.actor is None:
+                self.actor = actors.allocate(self, self.eid)
+            actors.speed[self.actor] = value.speed
+            if container is not None:
+                if self._ai is None:
+                    container.scheduler.add(self)
+                elif self in container.dormant:
+                    container.wake(self) # The new AI may have something to do out of sight
+        self._ai = value
+
     def send_to_back(self):
         # Make this object be drawn first, so all others appear above it if they're in the same tile
         global objects
         objects.remove(self)
         objects.insert(0, self)
+        mark_dirty(self.x, self.y)
 
     def move_towards(self, target_x, target_y):
         # Vector from this object to the target, and distance
@@ -316,56 +932,806 @@ class Object:
             self.y += dy
 
     def draw(self):
-        if (tcod.map_is_in_fov(fov_map, self.x, self.y) or (self.always_visible and map[self.x][self.y].explored)):
+        if (is_in_fov(self.x, self.y) or (self.always_visible and map.is_explored(self.x, self.y))):
             # set the colour and then draw the character that represents this oject at its position
             tcod.console_set_default_foreground(con, self.colour)
             tcod.console_put_char(con, self.x, self.y, self.char, tcod.BKGND_NONE)
 
     def clear(self):
-        # erase the character that represents this object
-        if TRADITIONAL_LOOK:
-            tcod.console_put_char_ex(con, self.x, self.y, '.', tcod.white, colour_dark_ground)
+        # erase the character that represents this object, the tile is repainted on the next render
+        mark_dirty(self.x, self.y)
+
+
+class Scheduler:
+    # When each actor (object with an AI) on a level acts next, as a heap of (time, order, ticket, actor)
+    # items. Every player turn the game time moves on by TURN_TIME, and only the actors due before then are
+    # popped, so a turn costs O(log n) per actor that acts, and actors that aren't scheduled cost nothing.
+    # Actors due at the same time act in the order they joined, which is their order in the ObjectList.
+    # The rest of an actor's state is in its row of entities.actors: speed, order, and the ticket it was
+    # last added with. Removing an actor only changes its state there: an item whose ticket isn't the
+    # actor's, or whose actor isn't awake, is stale and skipped when it comes up
+    def __init__(self):
+        self.time = 0
+        self.heap = []
+        self.joined = 0
+        self.tickets = 0
+
+    def __len__(self):
+        return len(self.actors())
+
+    def __contains__(self, actor):
+        # For an actor on this level
+        return actor.actor is not None and entities.actors.state[actor.actor] == ACTOR_AWAKE
+
+    def live(self, item):
+        row = item[3].actor
+        return row is not None and entities.actors.ticket[row] == item[2] and entities.actors.state[row] == ACTOR_AWAKE
+
+    def add(self, actor, delay=0, order=None):
+        # Schedule an actor to act delay after the current time (0: on the next turn). An actor coming back
+        # (see ObjectList.wake) is given the order it had, so that it acts in the same place as before; one
+        # joining starts with no alert (see make_noise)
+        actors = entities.actors
+        row = actor.actor
+        if order is None:
+            order = self.joined
+            self.joined += 1
+            actors.alert_until[row] = 0
+        self.tickets += 1
+        (actors.order[row], actors.ticket[row], actors.state[row]) = (order, self.tickets, ACTOR_AWAKE)
+        heapq.heappush(self.heap, (self.time + delay, order, self.tickets, actor))
+
+    def remove(self, actor):
+        row = actor.actor
+        if row is not None and entities.actors.state[row] == ACTOR_AWAKE:
+            entities.actors.state[row] = 0
+
+    def actors(self):
+        return [item[3] for item in sorted(self.heap, key=lambda item: item[1]) if self.live(item)]
+
+    def turn(self):
+        # Move on by one player turn and yield the actors due, in the order they act. Each one is put back
+        # for its next action before it acts, so a fast actor can come up again in the same turn
+        self.time += TURN_TIME
+        heap = self.heap
+        actors = entities.actors
+        (speeds, tickets, states) = (actors.speed, actors.ticket, actors.state)
+        while heap and heap[0][0] < self.time:
+            (due, order, ticket, actor) = heapq.heappop(heap)
+            row = actor.actor
+            if row is None or tickets[row] != ticket or states[row] != ACTOR_AWAKE:
+                continue # Removed (or added again) since it was scheduled
+            heapq.heappush(heap, (due + TURN_TIME * NORMAL_SPEED // speeds[row], order, ticket, actor))
+            yield actor
+
+
+class DormantActors:
+    # The actors sleeping on a level (out of the Scheduler, so they cost nothing per turn), bucketed by
+    # DORMANT_BUCKET_SIZE squares so that waking those near a point only looks at the buckets around it.
+    # Sleeping actors don't move, so their bucket stays right. Their rows of entities.actors say they are
+    # asleep and keep their order in the Scheduler
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, actor):
+        # For an actor on this level
+        return actor.actor is not None and entities.actors.state[actor.actor] == ACTOR_ASLEEP
+
+    def add(self, actor):
+        self.buckets.setdefault(self.bucket(actor), []).append(actor)
+        (entities.actors.state[actor.actor], entities.actors.alert_until[actor.actor]) = (ACTOR_ASLEEP, 0)
+        self.count += 1
+
+    def remove(self, actor):
+        # Take an actor out, returning its order in the Scheduler (None if it wasn't sleeping). Either way
+        # it forgets any alert
+        row = actor.actor
+        if row is None:
+            return None
+        entities.actors.alert_until[row] = 0
+        if entities.actors.state[row] != ACTOR_ASLEEP:
+            return None
+        entities.actors.state[row] = 0
+        self.count -= 1
+        bucket = self.bucket(actor)
+        actors = self.buckets[bucket]
+        actors.remove(actor)
+        if not actors:
+            del self.buckets[bucket]
+        return entities.actors.order[row]
+
+    @staticmethod
+    def bucket(actor):
+        return (actor.x // DORMANT_BUCKET_SIZE, actor.y // DORMANT_BUCKET_SIZE)
+
+    def actors(self):
+        return [actor for actors in self.buckets.values() for actor in actors]
+
+    def in_rect(self, x1, y1, x2, y2):
+        # Return the sleeping actors between (x1, y1) and (x2, y2) inclusive
+        found = []
+        for bucket_y in range(y1 // DORMANT_BUCKET_SIZE, y2 // DORMANT_BUCKET_SIZE + 1):
+            for bucket_x in range(x1 // DORMANT_BUCKET_SIZE, x2 // DORMANT_BUCKET_SIZE + 1):
+                for actor in self.buckets.get((bucket_x, bucket_y), ()):
+                    if x1 <= actor.x <= x2 and y1 <= actor.y <= y2:
+                        found.append(actor)
+        return found
+
+
+class ObjectList(list):
+    # The list of objects on the map, plus a spatial index from each tile to the objects on it, the
+    # Scheduler of the objects that act and the ones asleep. append/insert/remove and the x/y setters of
+    # Object keep the index in sync with the list
+    def __init__(self, objects=()):
+        list.__init__(self)
+        self.cells = {}
+        self.revision = 0 # Bumped whenever what is on some tile changes, so the panel knows to look again
+        self.scheduler = Scheduler()
+        self.dormant = DormantActors()
+        for obj in objects:
+            self.append(obj)
+
+    def __reduce__(self):
+        # Rebuild the index from the objects when unpickling, instead of pickling it
+        return (ObjectList, (list(self),))
+
+    def append(self, obj):
+        list.append(self, obj)
+        self.cells.setdefault((obj.x, obj.y), []).append(obj)
+        obj.container = self
+        self.revision += 1
+        if obj.ai:
+            self.scheduler.add(obj)
+
+    def insert(self, index, obj):
+        list.insert(self, index, obj)
+        cell = self.cells.setdefault((obj.x, obj.y), [])
+        if index == 0: # send_to_back, the only case used: drawn first on its tile too
+            cell.insert(0, obj)
+        else:
+            cell.append(obj)
+            cell.sort(key=self.index)
+        obj.container = self
+        self.revision += 1
+        if obj.ai:
+            self.scheduler.add(obj)
+
+    def remove(self, obj):
+        # Objects are often removed right after being added (send_to_back of a new item), so check the end
+        # first rather than searching the whole list
+        if self and self[-1] is obj:
+            list.pop(self)
         else:
-            tcod.console_put_char(con, self.x, self.y, ' ', tcod.BKGND_NONE)
+            list.remove(self, obj)
+        self._unlink(obj, obj.x, obj.y)
+        obj.container = None
+        self.revision += 1
+        self.scheduler.remove(obj)
+        self.dormant.remove(obj)
+
+    def _unlink(self, obj, x, y):
+        cell = self.cells[(x, y)]
+        cell.remove(obj)
+        if not cell:
+            del self.cells[(x, y)]
+
+    def relocate(self, obj, x, y):
+        # Called by Object before its position changes. An object moving onto a tile is drawn above the
+        # ones already there, which is what the list order gives for monsters walking over items
+        self._unlink(obj, obj.x, obj.y)
+        self.cells.setdefault((x, y), []).append(obj)
+        self.revision += 1
+
+    def actors(self):
+        # Return the objects that have an AI, awake or asleep. Monsters are a small part of the objects
+        # on a level, so this is what targeting loops over rather than the whole list
+        return self.scheduler.actors() + self.dormant.actors()
+
+    def sleep(self, actor):
+        # Take an actor out of the Scheduler until it is woken. Its order stays in its row
+        self.scheduler.remove(actor)
+        self.dormant.add(actor)
+
+    def wake(self, actor):
+        # Put a sleeping actor back in the Scheduler, to act on the next turn in its old order
+        self.scheduler.add(actor, order=self.dormant.remove(actor))
+
+    def at(self, x, y):
+        # Return the objects on a tile, in drawing order
+        return self.cells.get((x, y), ())
+
+    def blocking_at(self, x, y):
+        # Return True if a blocking object stands on the tile
+        for obj in self.cells.get((x, y), ()):
+            if obj.blocks:
+                return True
+        return False
+
+    def in_rect(self, x1, y1, x2, y2):
+        # Return the objects between (x1, y1) and (x2, y2) inclusive, row by row. Whichever is smaller,
+        # the rectangle or the set of occupied tiles, is scanned
+        if (x2 - x1 + 1) * (y2 - y1 + 1) <= len(self.cells):
+            found = []
+            for y in range(y1, y2 + 1):
+                for x in range(x1, x2 + 1):
+                    found.extend(self.cells.get((x, y), ()))
+            return found
+
+        found = []
+        for (x, y) in sorted(self.cells, key=lambda cell: (cell[1], cell[0])):
+            if x1 <= x <= x2 and y1 <= y <= y2:
+                found.extend(self.cells[(x, y)])
+        return found
+
+    def in_radius(self, x, y, radius):
+        # Return the objects whose distance to (x, y) is at most radius
+        r = int(radius)
+        return [obj for obj in self.in_rect(x - r, y - r, x + r, y + r)
+                if (obj.x - x) ** 2 + (obj.y - y) ** 2 <= radius ** 2]
+
+    def by_distance(self, x, y, max_range):
+        # Yield the objects at most max_range from (x, y), nearest first (then by row and column, and in
+        # drawing order on a tile). The tiles are looked up in rings of growing distance (the order of a disk
+        # stencil), so finding the nearest costs as much as the distance to it, not the number of objects
+        limit = max_range * max_range
+        for (dx, dy) in disk_stencil(int(math.ceil(max_range))).offsets:
+            if dx * dx + dy * dy > limit:
+                return
+            cell = self.cells.get((x + dx, y + dy))
+            if cell:
+                yield from list(cell) # A copy, in case the caller moves or kills what it is given
+
+
+NEIGHBOURS = ((0, -1), (0, 1), (-1, 0), (1, 0), (-1, -1), (1, -1), (-1, 1), (1, 1))
+
+
+class DistanceField:
+    # Walking distance, in steps (diagonals included), from each tile near a goal to that goal.
+    # Computed once for all the monsters chasing the goal, and only again when the goal moves or the
+    # map changes, so each chasing monster just has to look at the tiles around it
+    def __init__(self, limit):
+        self.limit = limit
+        self.key = None
+        self.distances = {} # tile index -> steps to the goal, for tiles up to limit steps away
+
+    def update(self, goal_x, goal_y):
+        key = (goal_x, goal_y, map.revision)
+        if key == self.key:
+            return
+        self.key = key
+
+        # Breadth-first search from the goal over walkable tiles, one ring of distance at a time
+        width, height = map.width, map.height
+        distances = {goal_y * width + goal_x: 0}
+        frontier = [(goal_x, goal_y)]
+        steps = 0
+        while frontier and steps < self.limit:
+            steps += 1
+            next_frontier = []
+            for (x, y) in frontier:
+                for (dx, dy) in NEIGHBOURS:
+                    (nx, ny) = (x + dx, y + dy)
+                    if 0 <= nx < width and 0 <= ny < height:
+                        i = ny * width + nx
+                        if i not in distances and not map.blocked[i]:
+                            distances[i] = steps
+                            next_frontier.append((nx, ny))
+            frontier = next_frontier
+        self.distances = distances
+
+    def distance(self, x, y):
+        # Steps from (x, y) to the goal, or None if it is further than the limit (or unreachable)
+        return self.distances.get(y * map.width + x)
+
+    def step(self, obj):
+        # Move obj to the free neighbouring tile closest to the goal. Returns False if it can't get closer
+        here = self.distance(obj.x, obj.y)
+        best = None
+        for (dx, dy) in NEIGHBOURS:
+            distance = self.distance(obj.x + dx, obj.y + dy)
+            if distance is not None and distance < here and not is_blocked(obj.x + dx, obj.y + dy):
+                if best is None or distance < best[0]:
+                    best = (distance, dx, dy)
+        if best is None:
+            return False
+        obj.move(best[1], best[2])
+        return True
+
+
+# Functions that components refer to, saved by name
+SAVED_FUNCTIONS = ('player_death', 'monster_death', 'cast_heal', 'cast_lightning', 'cast_fireball', 'cast_confuse')
+
+_BITS_TO_DIGITS = bytes.maketrans(b'\x00\x01', b'01')
+_DIGITS_TO_BITS = bytes.maketrans(b'01', b'\x00\x01')
+
+
+def pack_bits(plane):
+    # Pack a plane of 0/1 bytes into one bit per tile (tile i is bit i), via a base-2 integer
+    if not plane:
+        return b''
+    value = int(bytes(plane).translate(_BITS_TO_DIGITS)[::-1], 2)
+    return value.to_bytes((len(plane) + 7) // 8, 'little')
+
+
+def unpack_bits(data, length):
+    # The reverse of pack_bits
+    digits = format(int.from_bytes(data, 'little'), 'b').zfill(length)[::-1]
+    return bytearray(digits.encode().translate(_DIGITS_TO_BITS)[:length])
+
+
+class SaveWriter:
+    # Writes the save format: an uncompressed header (magic, version), then a zlib stream of records
+    def __init__(self, file):
+        self.file = file
+        self.compressor = zlib.compressobj()
+        file.write(SAVE_MAGIC + struct.pack('<H', SAVE_VERSION))
+
+    def write(self, data):
+        self.file.write(self.compressor.compress(data))
+
+    def close(self):
+        self.file.write(self.compressor.flush())
+
+    def int(self, value):
+        self.write(struct.pack('<i', value))
+
+    def uint(self, value):
+        self.write(struct.pack('<I', value))
+
+    def string(self, text):
+        data = text.encode('utf-8')
+        self.write(struct.pack('<I', len(data)) + data)
+
+    def blob(self, data):
+        self.write(struct.pack('<I', len(data)))
+        self.write(data)
+
+    def colour(self, colour):
+        self.write(bytes((colour.r, colour.g, colour.b)))
+
+
+class SaveReader:
+    # Reads the save format back, decompressing the file a chunk at a time as records are needed
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, file):
+        self.file = file
+        self.decompressor = zlib.decompressobj()
+        self.buffer = b''
+        self.offset = 0
+        header = file.read(len(SAVE_MAGIC) + 2)
+        if header[:len(SAVE_MAGIC)] != SAVE_MAGIC:
+            raise ValueError('Not a saved game')
+        (self.version,) = struct.unpack('<H', header[len(SAVE_MAGIC):])
+        if self.version > SAVE_VERSION:
+            raise ValueError('Saved game is from a newer version (' + str(self.version) + ')')
+
+    def read(self, size):
+        while len(self.buffer) - self.offset < size:
+            chunk = self.file.read(self.CHUNK_SIZE)
+            if not chunk:
+                raise EOFError('Saved game is truncated')
+            self.buffer = self.buffer[self.offset:] + self.decompressor.decompress(chunk)
+            self.offset = 0
+        data = self.buffer[self.offset:self.offset + size]
+        self.offset += size
+        return data
+
+    def int(self):
+        return struct.unpack('<i', self.read(4))[0]
+
+    def uint(self):
+        return struct.unpack('<I', self.read(4))[0]
+
+    def string(self):
+        (length,) = struct.unpack('<I', self.read(4))
+        return self.read(length).decode('utf-8')
+
+    def blob(self):
+        (length,) = struct.unpack('<I', self.read(4))
+        return self.read(length)
+
+    def colour(self):
+        return tcod.Color(*self.read(3))
+
+
+def ai_record(ai):
+    # AI components are saved by class name, a basic monster with its speed; a confused monster also saves
+    # the AI it will go back to
+    if isinstance(ai, ConfusedMonster):
+        return ('ConfusedMonster', ai.num_turns, ai_record(ai.old_ai))
+    if isinstance(ai, BasicMonster):
+        return ('BasicMonster', ai.speed)
+    return (type(ai).__name__,) if ai else ('',)
+
+
+def write_ai(writer, record):
+    writer.string(record[0])
+    if record[0] == 'ConfusedMonster':
+        writer.int(record[1])
+        write_ai(writer, record[2])
+    elif record[0] == 'BasicMonster':
+        writer.int(record[1])
+
+
+def read_ai(reader, owner):
+    kind = reader.string()
+    if kind == 'BasicMonster':
+        ai = BasicMonster(reader.int() if reader.version >= 4 else NORMAL_SPEED)
+    elif kind == 'ConfusedMonster':
+        num_turns = reader.int()
+        ai = ConfusedMonster(read_ai(reader, owner), num_turns)
+    elif kind == '':
+        return None
+    else:
+        raise ValueError('Unknown AI in saved game: ' + kind)
+    ai.owner = owner
+    return ai
+
+
+def function_name(function):
+    return function.__name__ if function else ''
+
+
+def read_function(reader):
+    name = reader.string()
+    if name == '':
+        return None
+    if name not in SAVED_FUNCTIONS:
+        raise ValueError('Unknown function in saved game: ' + name)
+    return globals()[name]
+
+
+def entity_record(obj, entity_index):
+    # Copy everything saved about an object into plain tuples, so it can be written later (even on another
+    # thread) while the game carries on. Equipment refers to its wearer by entity index
+    flags = (obj.blocks | obj.always_visible << 1 | bool(obj.fighter) << 2 | bool(obj.ai) << 3 |
+             bool(obj.item) << 4 | bool(obj.equipment) << 5)
+    fighter = obj.fighter
+    if fighter:
+        fighter = (fighter.hp, fighter.base_max_hp, fighter.base_defense, fighter.base_power, fighter.xp,
+                   function_name(fighter.death_function))
+    equipment = obj.equipment
+    if equipment:
+        equipment = (equipment.slot, equipment.power_bonus, equipment.defense_bonus, equipment.max_hp_bonus,
+                     entity_index[id(equipment.wearer)] if equipment.is_equipped else -1)
+    use_function = function_name(obj.item.use_function) if obj.item else ''
+    return (flags, obj.x, obj.y, obj.char, obj.name, (obj.colour.r, obj.colour.g, obj.colour.b),
+            fighter, ai_record(obj.ai), use_function, equipment)
+
+
+def write_entity(writer, record):
+    # One record per object: a flags byte saying which components follow, the object's own fields,
+    # then each component
+    (flags, x, y, char, name, colour, fighter, ai, use_function, equipment) = record
+    writer.write(bytes((flags,)))
+    writer.int(x)
+    writer.int(y)
+    writer.string(char)
+    writer.string(name)
+    writer.write(bytes(colour))
+    if fighter:
+        for value in fighter[:5]:
+            writer.int(value)
+        writer.string(fighter[5])
+    if flags & 8:
+        write_ai(writer, ai)
+    if equipment:
+        writer.string(equipment[0])
+        for value in equipment[1:]:
+            writer.int(value)
+    elif flags & 16:
+        writer.string(use_function)
+
+
+def read_entity(reader):
+    # Returns the object and the entity index of whoever wears it (-1 if it isn't worn equipment)
+    flags = reader.read(1)[0]
+    (x, y) = (reader.int(), reader.int())
+    (char, name, colour) = (reader.string(), reader.string(), reader.colour())
+    obj = Object(x, y, char, name, colour, blocks=bool(flags & 1), always_visible=bool(flags & 2))
+    wearer_index = -1
+    if flags & 4:
+        (hp, max_hp, defense, power, xp) = [reader.int() for i in range(5)]
+        obj.fighter = Fighter(max_hp, defense, power, xp, read_function(reader))
+        obj.fighter.hp = hp
+        obj.fighter.owner = obj
+    if flags & 8:
+        obj.ai = read_ai(reader, obj)
+    if flags & 32:
+        slot = reader.string()
+        (power, defense, max_hp) = [reader.int() for i in range(3)]
+        obj.equipment = Equipment(slot, power, defense, max_hp)
+        obj.equipment.owner = obj
+        obj.item = Item()
+        obj.item.owner = obj
+        wearer_index = reader.int()
+    elif flags & 16:
+        obj.item = Item(read_function(reader))
+        obj.item.owner = obj
+    return (obj, wearer_index)
+
+
+def map_record(level_map):
+    return (level_map.width, level_map.height, bytes(level_map.blocked), bytes(level_map.block_sight),
+            bytes(level_map.explored))
+
+
+def write_map(writer, record):
+    # The map as bit-packed planes
+    (width, height, blocked, block_sight, explored) = record
+    writer.int(width)
+    writer.int(height)
+    for plane in (blocked, block_sight, explored):
+        writer.blob(pack_bits(plane))
+
+
+def read_map(reader):
+    (width, height) = (reader.int(), reader.int())
+    level_map = Map(width, height)
+    level_map.blocked = unpack_bits(reader.blob(), width * height)
+    level_map.block_sight = unpack_bits(reader.blob(), width * height)
+    level_map.explored = unpack_bits(reader.blob(), width * height)
+    return level_map
+
+
+def write_entities(writer, records):
+    writer.int(len(records))
+    for record in records:
+        write_entity(writer, record)
+
+
+def read_entities(reader):
+    # Returns the objects and, for each, the index of whoever wears it (see read_entity)
+    entities = []
+    wearers = []
+    for i in range(reader.int()):
+        (obj, wearer_index) = read_entity(reader)
+        entities.append(obj)
+        wearers.append(wearer_index)
+    return (entities, wearers)
+
+
+def restore_equipment(entities, wearers):
+    # Put worn equipment back on, which also restores the wearers' bonuses
+    for (obj, wearer_index) in zip(entities, wearers):
+        if wearer_index >= 0:
+            obj.equipment.is_equipped = True
+            obj.equipment.wearer = entities[wearer_index]
+            entities[wearer_index].fighter.add_equipment(obj.equipment)
+
+
+def snapshot_game():
+    # Capture everything save_game writes as immutable data: the map planes are copied in one go and each
+    # object becomes a small tuple, so this is cheap enough to do between two turns
+    entities = list(objects) + inventory
+    entity_index = {id(obj): i for (i, obj) in enumerate(entities)}
+    return {
+        'globals': (game_seed, dungeon_level, turn_count, player.level, game_state),
+        'map': map_record(map),
+        'entities': [entity_record(obj, entity_index) for obj in entities],
+        'references': (len(objects), entity_index[id(player)], entity_index[id(stairs)],
+                       entity_index[id(upstairs)] if upstairs else -1),
+        'messages': list(game_msgs.messages), # Messages don't change, and are only formatted when written
+        'levels': level_store.snapshot(),
+    }
+
+
+def write_atomically(path, write):
+    # Call write(writer) on a SaveWriter for a file next to path, then rename it over path, so a save that
+    # is cut short never damages the last good one
+    temp_path = path + '.' + str(threading.get_ident()) + '.tmp'
+    with open(temp_path, 'wb') as file:
+        writer = SaveWriter(file)
+        write(writer)
+        writer.close()
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+
+
+def write_snapshot(snapshot, path):
+    # Write a snapshot in the save format: game state, the map, then a flat table of entities (objects on
+    # the map, then the inventory) that everything else refers to by index, the messages, and which
+    # levels LevelStore has (with the generation of each one's file). Those levels are written to their own
+    # files first
+    (seed, levels_in_memory, levels, first_unsaved) = snapshot['levels']
+    for (depth, serial, level_snapshot) in levels_in_memory:
+        write_level_file(level_snapshot, level_path(seed, depth, serial))
+
+    def write(writer):
+        (seed, level, turns, player_level, state) = snapshot['globals']
+        writer.uint(seed)
+        for value in (level, turns, player_level):
+            writer.int(value)
+        writer.string(state)
+
+        write_map(writer, snapshot['map'])
+        write_entities(writer, snapshot['entities'])
+        for value in snapshot['references']:
+            writer.int(value)
+
+        writer.int(len(snapshot['messages']))
+        for message in snapshot['messages']:
+            writer.string(message.text)
+            writer.colour(message.colour)
+            writer.int(message.turn)
+
+        writer.int(len(levels))
+        for (depth, serial) in levels:
+            writer.int(depth)
+            writer.int(serial)
+    write_atomically(path, write)
+    prune_level_files(seed, levels, first_unsaved)
 
 
 def save_game():
-    # Open a newly empty shelve (possibly overwriting an old one) to write the game data
-    file = shelve.open('savegame', 'n')
-    file['map'] = map
-    file['objects'] = objects
-    file['player_index'] = objects.index(player) # Index of player in objects list
-    file['inventory'] = inventory
-    file['game_msgs'] = game_msgs
-    file['game_state'] = game_state
-    file['stairs_index'] = objects.index(stairs)
-    file['dungeon_level'] = dungeon_level
-    file.close()
+    # Write the game to SAVE_FILE
+    write_snapshot(snapshot_game(), SAVE_FILE)
+
+
+class Autosaver:
+    # Saves the game in the background: the main loop only takes a snapshot, and a worker thread writes it.
+    # Only the latest snapshot waiting to be written is kept, so a slow disk never makes the game wait
+    def __init__(self, path=SAVE_FILE):
+        self.path = path
+        self.pending = None
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.idle = threading.Event()
+        self.idle.set()
+        self.stats = {'saves': 0, 'skipped': 0, 'errors': 0, 'last_snapshot_ms': 0.0,
+                      'last_write_ms': 0.0, 'max_write_ms': 0.0, 'last_error': None}
+        self.thread = threading.Thread(target=self.run, name='autosave', daemon=True)
+        self.thread.start()
+
+    def save(self):
+        # Snapshot the game now and hand it over to the worker
+        start = time.perf_counter()
+        snapshot = snapshot_game()
+        with self.lock:
+            if self.pending is not None:
+                self.stats['skipped'] += 1 # the previous one was never written, this one replaces it
+            self.pending = snapshot
+            self.idle.clear()
+        self.stats['last_snapshot_ms'] = (time.perf_counter() - start) * 1000
+        self.wakeup.set()
+
+    def run(self):
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            with self.lock:
+                (snapshot, self.pending) = (self.pending, None)
+            try:
+                if snapshot is not None:
+                    start = time.perf_counter()
+                    try:
+                        write_snapshot(snapshot, self.path)
+                        self.stats['saves'] += 1
+                    except Exception as error: # Whatever went wrong, the worker must live on for wait()
+                        self.stats['errors'] += 1
+                        self.stats['last_error'] = '%s: %s' % (type(error).__name__, error)
+                    write_ms = (time.perf_counter() - start) * 1000
+                    self.stats['last_write_ms'] = write_ms
+                    self.stats['max_write_ms'] = max(self.stats['max_write_ms'], write_ms)
+            finally:
+                with self.lock:
+                    if self.pending is None:
+                        self.idle.set()
+
+    def wait(self):
+        # Block until everything submitted has been written
+        self.idle.wait()
+
+    def report(self):
+        return ('Autosave: %(saves)d saves, %(skipped)d skipped, %(errors)d errors, last snapshot %(last_snapshot_ms).1fms, '
+                'last write %(last_write_ms).1fms, slowest write %(max_write_ms).1fms' % self.stats)
 
 
 def load_game():
-    # Open the previously saved shelve and load the game data
-    global map, objects, player, inventory, game_msgs, game_state, stairs, dungeon_level
+    # Load SAVE_FILE, or a shelve from before it existed (which is then rewritten in the new format)
+    close_world()
+    if not os.path.exists(SAVE_FILE):
+        load_legacy_game()
+        save_game()
+    else:
+        load_save_file()
+    request_next_level()
+
+
+def load_save_file():
+    # Read SAVE_FILE back into the game's globals
+    global map, objects, player, inventory, game_msgs, game_state, stairs, upstairs, dungeon_level, turn_count, game_seed
+    global entities
+
+    with open(SAVE_FILE, 'rb') as file:
+        reader = SaveReader(file)
+        game_seed = reader.uint()
+        (dungeon_level, turn_count, player_level) = [reader.int() for i in range(3)]
+        game_state = reader.string()
+
+        map = read_map(reader)
+        entities = EntityStore() # Nothing of the game being replaced is used again
+        (loaded, wearers) = read_entities(reader)
+        (num_objects, player_index, stairs_index) = (reader.int(), reader.int(), reader.int())
+        upstairs_index = reader.int() if reader.version >= 2 else -1
+
+        game_msgs = MessageLog()
+        for i in range(reader.int()):
+            (text, colour) = (reader.string(), reader.colour())
+            game_msgs.add(text, (), colour, reader.int() if reader.version >= 3 else 0) # Before 3, the last lines shown
+
+        if reader.version >= 5:
+            levels = [(reader.int(), reader.int()) for i in range(reader.int())]
+        elif reader.version >= 2: # Before 5, each level had a single file, see level_path
+            levels = [(reader.int(), 0) for i in range(reader.int())]
+        else:
+            levels = []
+
+    objects = ObjectList(loaded[:num_objects])
+    inventory = loaded[num_objects:]
+    player = loaded[player_index]
+    player.level = player_level
+    stairs = loaded[stairs_index]
+    upstairs = loaded[upstairs_index] if upstairs_index >= 0 else None
 
-    file = shelve.open('savegame', 'r')
+    restore_equipment(loaded, wearers)
+
+    # The random streams restart from the level's seed, their position within it isn't saved
+    seed_level_rngs(dungeon_level)
+    level_store.reset(game_seed, levels)
+
+    initialize_fov()
+
+
+def load_legacy_game():
+    # Open a shelve saved before SAVE_VERSION 1 and load the game data
+    global map, objects, player, inventory, game_msgs, game_state, stairs, upstairs, dungeon_level, turn_count, game_seed
+    global entities
+
+    file = shelve.open(LEGACY_SAVE_FILE, 'r')
+    entities = EntityStore() # Nothing of the game being replaced is used again
     map = file['map']
+    if not isinstance(map, Map): # Saves from before the array-backed map stored a list of lists of Tiles
+        map = Map.from_tiles(map)
     objects = file['objects']
+    if not isinstance(objects, ObjectList): # Saves from before the spatial index stored a plain list
+        objects = ObjectList(objects)
     player = objects[file['player_index']] # Get index of player in objects list and access it
     inventory = file['inventory']
-    game_msgs = file['game_msgs']
+    game_msgs = MessageLog()
+    for (line, colour) in file['game_msgs']: # The lines that were shown in the panel
+        game_msgs.add(line, (), colour, 0)
     game_state = file['game_state']
     stairs = objects[file['stairs_index']]
     dungeon_level = file['dungeon_level']
+    turn_count = file.get('turn_count', 0)
+    game_seed = file.get('game_seed', 0)
     file.close()
+    upstairs = None # Older saves have no way back up
+
+    # The random streams restart from the level's seed, their position within it isn't saved
+    seed_level_rngs(dungeon_level)
+    level_store.reset(game_seed)
+
+    # Saves from before equipment bonuses were cached on Fighter only mark the items as equipped
+    for obj in inventory:
+        if obj.equipment and obj.equipment.is_equipped and obj.equipment.wearer is None:
+            obj.equipment.wearer = player
+            player.fighter.add_equipment(obj.equipment)
 
     initialize_fov()
 
 
-def get_equipped_in_slot(slot): # Returns the equipment in a slot, or None if it's empty
-    for obj in inventory:
-        if obj.equipment and obj.equipment.slot == slot and obj.equipment.is_equipped:
-            return obj.equipment
-    return None
+def get_equipped_in_slot(slot, obj=None): # Returns the equipment in a slot (of the player by default), or None if it's empty
+    if obj is None:
+        obj = player
+    return obj.fighter.equipped.get(slot) if obj.fighter and obj.fighter.equipped else None
 
 
 def from_dungeon_level(table):
@@ -377,27 +1743,518 @@ def from_dungeon_level(table):
     return 0
 
 
+def derive_seed(*parts):
+    # Mix the game seed with a stream name, level... into an independent 32-bit seed
+    return zlib.crc32(repr(parts).encode()) & 0xffffffff
+
+
+def seed_level_rngs(level):
+    # (Re)create the random streams for a level. Each subsystem has its own stream, so one extra roll
+    # in, say, the loot code doesn't change the layout of the dungeon
+    for name in RNG_STREAMS:
+        # CMWC is what libtcodpy's random_new_from_seed used, so the streams (and recorded games) are unchanged
+        seed = derive_seed(game_seed, name, level)
+        rngs[name] = tcod_random.Random(tcod_random.COMPLEMENTARY_MULTIPLY_WITH_CARRY, seed)
+
+
 def next_level():
     global dungeon_level
     # Advance to the next level
-    add_message('You take a moment to rest, and recover some strength.', tcod.light_violet)
-    player.fighter.heal(player.fighter.max_hp / 2) # Heal the player by 50%
-
-    add_message('You descend the stairs.')
+    if not world:
+        leave_level()
     dungeon_level += 1
-    make_map()
+    level = level_store.take(dungeon_level)
+    if level is not None:
+        # Been here before: arrive on its up stairs
+        add_message('You descend the stairs.')
+        enter_level(*level, arrive_at=level[3])
+    else:
+        add_message('You take a moment to rest, and recover some strength.', tcod.light_violet)
+        player.fighter.heal(player.fighter.max_hp // 2) # Heal the player by 50%
+
+        add_message('You descend the stairs.')
+        level = pregenerator.take(game_seed, dungeon_level) if pregenerator and not world_size else None
+        if level is not None:
+            install_level(*level)
+        else:
+            make_level() # Not pre-generated (or not finished yet): generate it now
     initialize_fov()
+    request_next_level()
 
 
-def get_all_equipped(obj): # Returns a list of equipped items
-    if obj == player:
-        equipped_list = []
-        for item in inventory:
-            if item.equipment and item.equipment.is_equipped:
-                equipped_list.append(item.equipment)
-        return equipped_list
+def previous_level():
+    global dungeon_level
+    # Go back up to the level above, arriving on its down stairs
+    add_message('You climb the stairs.')
+    leave_level()
+    dungeon_level -= 1
+    level = level_store.take(dungeon_level)
+    enter_level(*level, arrive_at=level[2])
+    initialize_fov()
+
+
+def leave_level():
+    # Put the current level, without the player, in the level store
+    objects.remove(player)
+    level_store.put(dungeon_level, (map, objects, stairs, upstairs))
+
+
+def enter_level(level_map, level_objects, level_stairs, level_upstairs, arrive_at):
+    # Make a level from the store the current one, with the player standing on arrive_at
+    global map, objects, stairs, upstairs
+    (map, objects, stairs, upstairs) = (level_map, level_objects, level_stairs, level_upstairs)
+    player.x = arrive_at.x
+    player.y = arrive_at.y
+    objects.append(player)
+    seed_level_rngs(dungeon_level) # As after loading a game, the streams restart from the level's seed
+
+
+def request_next_level():
+    # Start generating the level below in the background, unless it has been visited already
+    if pregenerator and not world_size and not level_store.has(dungeon_level + 1):
+        pregenerator.request(game_seed, dungeon_level + 1)
+
+
+def pregenerate_level(seed, depth):
+    # Generate the level at a depth, from the game seed alone. Runs in a worker process: the globals changed
+    # here are the worker's own. Levels only depend on the seed and depth (see seed_level_rngs), so the
+    # result is exactly what make_map would build in the game. A stand-in marks where the player starts.
+    # The level comes back in the save format, as read_pregenerated_level expects, so that its objects are
+    # only made (and given rows of entities) on the main thread when the level is used
+    global game_seed, dungeon_level, player, entities
+    (game_seed, dungeon_level) = (seed, depth)
+    entities = EntityStore() # The worker's previous levels are done with
+    player = Object(0, 0, '@', 'player', tcod.white, blocks=True)
+    make_map()
+    buffer = io.BytesIO()
+    writer = SaveWriter(buffer)
+    write_level(writer, level_snapshot((map, objects, stairs, upstairs)))
+    writer.int(objects.index(player))
+    writer.close()
+    return buffer.getvalue()
+
+
+def read_pregenerated_level(data):
+    # The level and stand-in from pregenerate_level, as install_level takes them
+    reader = SaveReader(io.BytesIO(data))
+    level = read_level(reader)
+    return level + (level[1][reader.int()],)
+
+
+def install_level(level_map, level_objects, level_stairs, level_upstairs, stand_in):
+    # Make a pre-generated level the current one, putting the player where the stand-in is
+    global map, objects, stairs, upstairs
+    player.x = stand_in.x
+    player.y = stand_in.y
+    map = level_map
+    objects = ObjectList(player if obj is stand_in else obj for obj in level_objects)
+    release_entity(stand_in)
+    (stairs, upstairs) = (level_stairs, level_upstairs)
+    seed_level_rngs(dungeon_level) # Start the streams used during play (AI) where make_map would have
+
+
+def level_path(seed, depth, serial):
+    # Each file written for a level is a new generation with its own serial, so a save keeps the files it
+    # refers to however the level changes later. Serial 0 is the one file per level of saves before version 5
+    if serial == 0:
+        return os.path.join(LEVEL_DIR, 'level-%d-%d.sav' % (seed, depth))
+    return os.path.join(LEVEL_DIR, 'level-%d-%d-%d.sav' % (seed, depth, serial))
+
+
+def level_snapshot(level):
+    # Like snapshot_game, for a level in the store: the map, its objects, and which of them are the stairs
+    (level_map, level_objects, level_stairs, level_upstairs) = level
+    entity_index = {id(obj): i for (i, obj) in enumerate(level_objects)}
+    return (map_record(level_map), [entity_record(obj, entity_index) for obj in level_objects],
+            (entity_index[id(level_stairs)], entity_index[id(level_upstairs)] if level_upstairs else -1))
+
+
+def write_level(writer, snapshot):
+    # The map and entities parts of the save format on their own, then which entities are the stairs
+    (map_data, entities, references) = snapshot
+    write_map(writer, map_data)
+    write_entities(writer, entities)
+    for value in references:
+        writer.int(value)
+
+
+def read_level(reader):
+    level_map = read_map(reader)
+    (entities, wearers) = read_entities(reader)
+    (stairs_index, upstairs_index) = (reader.int(), reader.int())
+    restore_equipment(entities, wearers)
+    return (level_map, ObjectList(entities), entities[stairs_index],
+            entities[upstairs_index] if upstairs_index >= 0 else None)
+
+
+def write_level_file(snapshot, path):
+    # A level file is a level in the save format (see write_level)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_atomically(path, lambda writer: write_level(writer, snapshot))
+
+
+def read_level_file(path):
+    with open(path, 'rb') as file:
+        return read_level(SaveReader(file))
+
+
+def level_file_serials(seed):
+    # The serials of the level files this game has on disk (see level_path)
+    try:
+        names = os.listdir(LEVEL_DIR)
+    except OSError:
+        return []
+    prefix = 'level-%d-' % seed
+    serials = []
+    for name in names:
+        parts = name[len(prefix):-len('.sav')].split('-')
+        if name.startswith(prefix) and name.endswith('.sav') and len(parts) == 2 and parts[1].isdigit():
+            serials.append(int(parts[1]))
+    return serials
+
+
+def prune_level_files(seed, levels, first_unsaved):
+    # Once a save has been written: delete the level files of other games, and those of this game that the
+    # save doesn't refer to, as long as they are older than it. Files from first_unsaved on were written
+    # after the save's snapshot was taken (by LevelStore.evict), and the game may still need them
+    try:
+        names = os.listdir(LEVEL_DIR)
+    except OSError:
+        return
+    keep = {os.path.basename(level_path(seed, depth, serial)) for (depth, serial) in levels}
+    prefix = 'level-%d-' % seed
+    for name in names:
+        if not name.startswith('level-') or name in keep:
+            continue
+        if name.startswith(prefix):
+            # Of this game's files, only whole ones (not one being written) older than the save can go
+            (stem, extension) = os.path.splitext(name[len(prefix):])
+            parts = stem.split('-')
+            if extension != '.sav' or (len(parts) == 2 and parts[1].isdigit() and int(parts[1]) >= first_unsaved):
+                continue
+        try:
+            os.remove(os.path.join(LEVEL_DIR, name))
+        except OSError:
+            pass
+
+
+class LevelStore:
+    # The levels the player has left, so the stairs can be taken back up. The most recently left ones stay in
+    # memory, up to a budget in (roughly estimated) bytes; older ones are written to a file each, in the save
+    # format, and read back when the player returns. A level doesn't change while the player is elsewhere, so
+    # its file stays good until the level is visited again. Every file written is a new generation (see
+    # level_path), so neither an autosave still being written nor an older save ever sees a file change
+    def __init__(self, budget=LEVEL_MEMORY_BUDGET):
+        self.budget = budget
+        self.reset(0)
+        self.stats = {'from_memory': 0, 'from_disk': 0, 'evicted': 0}
+
+    def reset(self, seed, on_disk=()):
+        # Forget every level, for a new game or a loaded one (whose left levels are all on disk, given as
+        # (depth, serial)). New files get serials above any this game has on disk
+        self.seed = seed
+        self.resident = collections.OrderedDict() # depth -> level, least recently left first
+        self.snapshots = {} # depth -> (serial, level_snapshot) of a resident level, taken when first needed
+        self.on_disk = dict(on_disk) # depth -> serial of its up to date file
+        self.next_serial = max(list(self.on_disk.values()) + level_file_serials(seed), default=0) + 1
+        self.size = 0
+
+    def new_serial(self):
+        self.next_serial += 1
+        return self.next_serial - 1
+
+    def has(self, depth):
+        return depth in self.resident or depth in self.on_disk
+
+    def put(self, depth, level):
+        self.resident[depth] = level
+        self.size += self.level_size(level)
+        self.on_disk.pop(depth, None)
+        while self.size > self.budget and len(self.resident) > 1:
+            self.evict()
+
+    def take(self, depth):
+        # Remove a level from the store and return it, or None if it was never visited
+        if depth in self.resident:
+            level = self.resident.pop(depth)
+            self.size -= self.level_size(level)
+            self.snapshots.pop(depth, None)
+            self.stats['from_memory'] += 1
+        elif depth in self.on_disk:
+            level = read_level_file(level_path(self.seed, depth, self.on_disk[depth]))
+            self.stats['from_disk'] += 1
+        else:
+            return None
+        self.on_disk.pop(depth, None) # it is about to change
+        return level
+
+    def evict(self):
+        # Write out the least recently left level and drop it from memory. It gets a file of its own rather than
+        # the one a snapshot may be writing for it, which is only for that snapshot's save
+        (depth, level) = self.resident.popitem(last=False)
+        self.size -= self.level_size(level)
+        snapshot = self.snapshots.pop(depth, (None, None))[1] or level_snapshot(level)
+        serial = self.new_serial()
+        write_level_file(snapshot, level_path(self.seed, depth, serial))
+        self.on_disk[depth] = serial
+        for obj in level[1]:
+            release_entity(obj)
+        self.stats['evicted'] += 1
+
+    def snapshot(self):
+        # For snapshot_game: the seed, (depth, serial, level_snapshot) for the levels that are only in memory,
+        # (depth, serial) for all the levels in the store, and the first serial not given out yet
+        in_memory = []
+        for depth in self.resident:
+            if depth not in self.snapshots:
+                self.snapshots[depth] = (self.new_serial(), level_snapshot(self.resident[depth]))
+            (serial, snapshot) = self.snapshots[depth]
+            in_memory.append((depth, serial, snapshot))
+        levels = sorted([(depth, serial) for (depth, serial, snapshot) in in_memory] + list(self.on_disk.items()))
+        return (self.seed, in_memory, levels, self.next_serial)
+
+    @staticmethod
+    def level_size(level):
+        return len(level[0].blocked) * 3 + len(level[1]) * LEVEL_OBJECT_SIZE
+
+    def report(self):
+        return ('Level store: %d levels in memory (%d KiB), %d on disk; %d returns from memory, %d from disk, '
+                '%d evicted' % (len(self.resident), self.size // 1024, len(self.on_disk),
+                                self.stats['from_memory'], self.stats['from_disk'], self.stats['evicted']))
+
+
+class LevelPregenerator:
+    # Generates the next level in a worker process ahead of time. If it isn't ready when the player takes
+    # the stairs, the level is generated synchronously instead, and that is counted in stats
+    def __init__(self):
+        self.executor = None
+        self.future = None
+        self.key = None
+        self.stats = {'ready': 0, 'fallbacks': 0}
+
+    def request(self, seed, depth):
+        if self.key == (seed, depth):
+            return
+        if self.future is not None:
+            self.future.cancel()
+        if self.executor is None:
+            self.executor = concurrent.futures.ProcessPoolExecutor(1, multiprocessing.get_context('spawn'))
+        self.key = (seed, depth)
+        self.future = self.executor.submit(pregenerate_level, seed, depth)
+
+    def take(self, seed, depth):
+        # Return the pre-generated level if it is finished, or None
+        (future, key) = (self.future, self.key)
+        (self.future, self.key) = (None, None)
+        if future is not None and key == (seed, depth) and future.done() and not future.cancelled():
+            try:
+                level = read_pregenerated_level(future.result())
+            except Exception: # e.g. the worker process died: just generate it here
+                level = None
+            if level is not None:
+                self.stats['ready'] += 1
+                return level
+        if future is not None:
+            future.cancel()
+        self.stats['fallbacks'] += 1
+        return None
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def report(self):
+        return 'Level pre-generation: %(ready)d ready in time, %(fallbacks)d generated synchronously' % self.stats
+
+
+class World:
+    # World mode: one huge level whose map is a ChunkedMap, played through a region of WORLD_REGION_CHUNKS
+    # chunks square around the player. The region is an ordinary Map with its own coordinates, holding only
+    # the objects on it, so FOV, rendering and AI work on it as on any level. A tile's world coordinates are
+    # its region coordinates plus origin. Objects outside the region are packed with the save format per
+    # chunk into a scratch file, except the stairs, which the game keeps referring to
+    def __init__(self, world_map):
+        self.map = world_map
+        self.origin = None
+        self.region_size = (min(WORLD_REGION_CHUNKS, world_map.chunks_x) * WORLD_CHUNK_SIZE,
+                            min(WORLD_REGION_CHUNKS, world_map.chunks_y) * WORLD_CHUNK_SIZE)
+        self.spill = tempfile.TemporaryFile()
+        self.packed = {} # (chunk_x, chunk_y) -> (offset, length) of its last batch of packed objects in spill
+        self.kept = {} # (chunk_x, chunk_y) -> objects that are never packed
+        self.stats = {'moves': 0, 'chunks_in': 0, 'chunks_out': 0}
+
+    def close(self):
+        self.map.close()
+        self.spill.close()
+
+    def region_origin(self, x, y):
+        # The chunk-aligned origin of the region with the world tile (x, y) in its middle chunk, as far as
+        # the edges of the world allow
+        size = WORLD_CHUNK_SIZE
+
+        def axis(position, chunks, region):
+            count = region // size
+            return max(0, min(position // size - count // 2, chunks - count)) * size
+        return (axis(x, self.map.chunks_x, self.region_size[0]), axis(y, self.map.chunks_y, self.region_size[1]))
+
+    def region_chunks(self, origin):
+        if origin is None:
+            return set()
+        (chunk_x, chunk_y) = self.map.chunk_at(*origin)
+        return {(chunk_x + i, chunk_y + j) for i in range(self.region_size[0] // WORLD_CHUNK_SIZE)
+                for j in range(self.region_size[1] // WORLD_CHUNK_SIZE)}
+
+    def store_objects(self, chunk, chunk_objects):
+        packed = [obj for obj in chunk_objects if obj is not stairs]
+        if len(packed) < len(chunk_objects):
+            self.kept.setdefault(chunk, []).append(stairs)
+        if packed:
+            self.pack_objects(chunk, packed)
+
+    def pack_objects(self, chunk, packed):
+        # A chunk's objects can be packed in more than one batch while the world is generated. Each batch is
+        # appended to the spill file (whose space isn't reused) after the offset and length of the one before
+        buffer = io.BytesIO()
+        writer = SaveWriter(buffer)
+        write_entities(writer, [entity_record(obj, {}) for obj in packed])
+        writer.close()
+        offset = self.spill.seek(0, io.SEEK_END)
+        self.spill.write(struct.pack('<qq', *self.packed.get(chunk, (-1, 0))))
+        self.spill.write(buffer.getvalue())
+        self.packed[chunk] = (offset, self.spill.tell() - offset)
+        for obj in packed:
+            release_entity(obj)
+
+    def load_objects(self, chunk):
+        chunk_objects = self.kept.pop(chunk, [])
+        (offset, length) = self.packed.pop(chunk, (-1, 0))
+        while offset >= 0:
+            self.spill.seek(offset)
+            (previous, previous_length) = struct.unpack('<qq', self.spill.read(16))
+            data = self.spill.read(length - 16)
+            (entities, wearers) = read_entities(SaveReader(io.BytesIO(data)))
+            chunk_objects.extend(entities)
+            (offset, length) = (previous, previous_length)
+        return chunk_objects
+
+    def spawn_batch(self, world_objects):
+        # During generation, before the stairs exist: pack away the objects spawned so far (in world
+        # coordinates) except the player, and return what is left to keep generating with
+        by_chunk = {}
+        for obj in world_objects:
+            if obj is not player:
+                obj.container = None
+                by_chunk.setdefault(self.map.chunk_at(obj.x, obj.y), []).append(obj)
+        for (chunk, chunk_objects) in sorted(by_chunk.items()):
+            self.pack_objects(chunk, chunk_objects)
+        dirty_cells.clear() # The first render of the region paints all of it anyway
+        return ObjectList([player])
+
+    def move_region(self, region_map, region_objects, x, y):
+        # Make the region the one around world tile (x, y). Takes the current region (None at first) and its
+        # objects, which are in region coordinates, and returns the new ones. Objects are moved with
+        # Object.place, as the ObjectList is rebuilt anyway
+        origin = self.region_origin(x, y)
+        if origin == self.origin:
+            return (region_map, region_objects)
+        (old_x, old_y) = self.origin or (0, 0)
+        (old_chunks, new_chunks) = (self.region_chunks(self.origin), self.region_chunks(origin))
+        if region_map is not None:
+            self.map.write_region(region_map, old_x, old_y)
+
+        staying = []
+        leaving = {}
+        for obj in region_objects:
+            obj.container = None
+            obj.place(obj.x + old_x, obj.y + old_y)
+            chunk = self.map.chunk_at(obj.x, obj.y)
+            if obj is player or chunk in new_chunks:
+                staying.append(obj)
+            else:
+                leaving.setdefault(chunk, []).append(obj)
+        for (chunk, chunk_objects) in sorted(leaving.items()):
+            self.store_objects(chunk, chunk_objects)
+        for chunk in sorted(new_chunks - old_chunks):
+            staying.extend(self.load_objects(chunk))
+        for obj in staying:
+            obj.place(obj.x - origin[0], obj.y - origin[1])
+
+        self.map.page_out(old_chunks - new_chunks)
+        self.stats['moves'] += 1
+        self.stats['chunks_in'] += len(new_chunks - old_chunks)
+        self.stats['chunks_out'] += len(old_chunks - new_chunks)
+        self.origin = origin
+        return (self.map.read_region(origin[0], origin[1], *self.region_size), ObjectList(staying))
+
+    def report(self):
+        return ('World: %dx%d tiles in %d chunks, region moved %d times (%d chunks in, %d out), resident memory %s' %
+                (self.map.width, self.map.height, self.map.chunks_x * self.map.chunks_y, self.stats['moves'],
+                 self.stats['chunks_in'], self.stats['chunks_out'], format_bytes(resident_memory())))
+
+
+def make_level():
+    # Generate the current level: a normal one, or a world in world mode
+    if world_size:
+        make_world(*world_size)
     else:
-        return [] # Other objects have no equipment
+        close_world()
+        make_map()
+
+
+def make_world(width, height):
+    # Generate a world of width x height tiles straight into a ChunkedMap, with as many rooms per tile as a
+    # normal level, then start playing the region around the player. Objects are packed away as they are
+    # spawned, so memory doesn't grow with the size of the world
+    global world, map, objects, upstairs
+    close_world()
+    world = World(ChunkedMap(width, height))
+    make_map(width, height, MAX_ROOMS * width * height // (MAP_WIDTH * MAP_HEIGHT), world)
+    if upstairs: # World levels aren't kept when the player leaves, so there is no way back up
+        objects.remove(upstairs)
+        release_entity(upstairs)
+        upstairs = None
+
+    (map, objects) = world.move_region(None, list(objects), player.x, player.y)
+    world.map.page_out() # Generation touched every chunk
+
+
+def close_world():
+    # Drop the world, with the objects of its region (the player goes on) and those kept outside it
+    global world
+    if world:
+        for obj in objects:
+            if obj is not player:
+                release_entity(obj)
+        for kept in world.kept.values():
+            for obj in kept:
+                release_entity(obj)
+        world.close()
+        world = None
+
+
+def move_world_region():
+    # In world mode, keep the player in the middle chunk of the region (if the world is big enough)
+    global map, objects
+    (origin_x, origin_y) = world.origin
+    (new_map, new_objects) = world.move_region(map, objects, player.x + origin_x, player.y + origin_y)
+    if new_map is not map:
+        (map, objects) = (new_map, new_objects)
+        initialize_fov()
+
+
+def resident_memory():
+    # The memory this process is using right now (on Linux; the peak elsewhere), in bytes
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        import resource # Unix only, like the peak it reports
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def format_bytes(size):
+    return '%.1f MiB' % (size / (1024 * 1024))
 
 
 def check_level_up():
@@ -407,11 +2264,11 @@ def check_level_up():
         # it is, therefore level up
         player.level += 1
         player.fighter.xp -= level_up_xp
-        add_message('Your battle skills grow stronger! You reach level ' + str(player.level) + '!', tcod.gold)
+        add_message('Your battle skills grow stronger! You reach level %d!', tcod.gold, (player.level,))
 
         choice = None
         while choice == None: # keep asking until a choice is made
-            choice = menu('Level up! Choose a stat to raise:\n',
+            choice = user_input.choose_option('Level up! Choose a stat to raise:\n',
                           ['Constitution (+10 HP, from ' + str(player.fighter.max_hp) + ')',
                            'Strength (+1 attack, from ' +str(player.fighter.power)+ ')',
                            'Agility (+1 defense, from ' + str(player.fighter.defense) + ')'], LEVEL_SCREEN_WIDTH)
@@ -425,17 +2282,17 @@ def check_level_up():
                 player.fighter.base_defense += 1
 
 
-def random_choice(chances_dict):
-    # Choose one option from dictionary of chances, returning its key
+def random_choice(chances_dict, rng):
+    # Choose one option from dictionary of chances, returning its key. rng is the level stream to roll with
     chances = chances_dict.values()
     strings = list(chances_dict)
 
-    return strings[random_choice_index(chances)]
+    return strings[random_choice_index(chances, rng)]
 
 
-def random_choice_index(chances): # Choose one option from list of chances, returning its index
+def random_choice_index(chances, rng): # Choose one option from list of chances, returning its index
     # The dice will land on some number between 1 and the sum of chances
-    dice = tcod.random_get_int(0, 1, sum(chances))
+    dice = rng.randint(1, sum(chances))
 
     # Go through all chances, keeping the sum so far
     running_sum = 0
@@ -457,44 +2314,136 @@ def target_monster(max_range=None):
             return None
 
         # Return the first-clicked monster, otherwise continue looping
-        for obj in objects:
-            if obj.x == x and obj.y == y and obj.fighter and obj != player:
+        for obj in objects.at(x, y):
+            if obj.fighter and obj != player:
                 return obj
 
 
 def target_tile(max_range=None):
-    # Return the position of a tile left-clicked in player's FOV optionally in range, or None,None if right-clicked
-    global key, mouse
-    global fov_recompute, fov_map
-    while True:
-        # Render the screen, this erases the inventory and shows the names of objects under the mouse
-        tcod.console_flush()
-        tcod.sys_check_for_event(tcod.EVENT_KEY_PRESS|tcod.EVENT_MOUSE, key, mouse)
-        render_all()
-
-        (x, y) = (mouse.cx, mouse.cy)
+    # Return the position of a tile chosen in player's FOV optionally in range, or None,None if cancelled.
+    # How the tile is chosen (mouse click, script...) is up to the input adapter
+    return user_input.choose_tile(max_range)
+
+
+class Stencil:
+    # The tiles an area effect covers, as offsets from its centre in a fixed order: nearest first, then by
+    # row and column. Each offset has the index of the one before it on the line from the centre (-1 for
+    # the centre's neighbours), so an effect stopped by walls reaches a tile only if it reached that one and
+    # it isn't a wall. covered says which offsets are affected (None: all); the rest are only passed through
+    __slots__ = ('offsets', 'parents', 'covered')
+
+    def __init__(self, offsets, parents, covered=None):
+        self.offsets = offsets
+        self.parents = parents
+        self.covered = covered
+
+
+def disk_stencil(radius):
+    # The tiles within radius of the centre (by Euclidean distance), the centre included
+    key = ('disk', radius)
+    if key not in stencils:
+        offsets = sorted(((dx, dy) for dy in range(-radius, radius + 1) for dx in range(-radius, radius + 1)
+                          if dx * dx + dy * dy <= radius * radius), key=lambda o: (o[0] ** 2 + o[1] ** 2, o[1], o[0]))
+        index = {offset: i for (i, offset) in enumerate(offsets)}
+        parents = []
+        for (dx, dy) in offsets:
+            # The tile before this one on a straight line from the centre, one step closer along the long axis
+            steps = max(abs(dx), abs(dy))
+            if steps <= 1:
+                parents.append(-1)
+            else:
+                parent = ((2 * dx * (steps - 1) + steps) // (2 * steps), (2 * dy * (steps - 1) + steps) // (2 * steps))
+                parents.append(index[parent])
+        stencils[key] = Stencil(offsets, parents)
+    return stencils[key]
+
+
+def cone_stencil(radius, direction, angle=CONE_ANGLE):
+    # The tiles within radius of the centre and within angle degrees around direction (dx, dy), the
+    # centre itself excluded: a breath or a spray coming out of the one using it
+    key = ('cone', radius, direction, angle)
+    if key not in stencils:
+        disk = disk_stencil(radius)
+        heading = math.atan2(direction[1], direction[0])
+        covered = []
+        for (dx, dy) in disk.offsets:
+            turn = abs((math.atan2(dy, dx) - heading + math.pi) % (2 * math.pi) - math.pi)
+            covered.append((dx, dy) != (0, 0) and math.degrees(turn) <= angle / 2 + 1e-9)
+        stencils[key] = Stencil(disk.offsets, disk.parents, covered)
+    return stencils[key]
+
+
+def area_tiles(x, y, stencil, walls_block=True):
+    # The map tiles covered by a stencil centred on (x, y), in the stencil's order. If walls_block, a tile
+    # is only covered if the effect can get there from the centre without going through a wall
+    (width, height, blocked) = (map.width, map.height, map.blocked)
+    (parents, covered) = (stencil.parents, stencil.covered)
+    passes = [False] * len(parents) # Whether the effect reached the tile and goes on past it
+    tiles = []
+    for (i, (dx, dy)) in enumerate(stencil.offsets):
+        (tile_x, tile_y) = (x + dx, y + dy)
+        if not (0 <= tile_x < width and 0 <= tile_y < height):
+            continue
+        if walls_block:
+            if parents[i] >= 0 and not passes[parents[i]]:
+                continue
+            passes[i] = not blocked[tile_y * width + tile_x]
+        if covered is None or covered[i]:
+            tiles.append((tile_x, tile_y))
+    return tiles
+
+
+def fighters_in_area(x, y, stencil, walls_block=True):
+    # The fighters an area effect centred on (x, y) hits: the rows of entities.fighters are walked for those
+    # standing on a tile of the area, on this level. Hits come in the order of the stencil, and on each
+    # tile in drawing order. The player is included if in the area
+    tiles = {tile: i for (i, tile) in enumerate(area_tiles(x, y, stencil, walls_block))}
+    (fighters, positions) = (entities.fighters, entities.positions)
+    (xs, ys, owners) = (positions.x, positions.y, positions.views)
+    hits = []
+    for (fighter, eid) in zip(fighters.views, fighters.eid):
+        if fighter is None or eid < 0:
+            continue
+        i = tiles.get((xs[eid], ys[eid]))
+        owner = owners[eid] if i is not None else None
+        if owner is not None and owner.container is objects and owner.fighter is fighter:
+            hits.append((i, owner))
+    hits.sort(key=lambda hit: (hit[0], objects.at(hit[1].x, hit[1].y).index(hit[1])))
+    return [obj for (i, obj) in hits]
+
+
+def visible_monsters(max_range):
+    # Yield the monsters (fighters other than the player) in FOV and at most max_range from the player,
+    # nearest first, then by row and column. See ObjectList.by_distance
+    for obj in objects.by_distance(player.x, player.y, max_range):
+        if obj.fighter and obj is not player and is_in_fov(obj.x, obj.y):
+            yield obj
+
+
+def nearest_monster(max_range):
+    # The nearest visible monster within max_range, or None
+    return next(visible_monsters(max_range), None)
+
+
+def nearest_monsters(k, max_range):
+    # The k nearest visible monsters within max_range (fewer if there aren't that many), nearest first
+    found = []
+    for monster in visible_monsters(max_range):
+        found.append(monster)
+        if len(found) == k:
+            break
+    return found
 
-        if (mouse.lbutton_pressed and tcod.map_is_in_fov(fov_map, x , y) and
-                (max_range is None or player.distance(x, y) <= max_range)):
-            return(x, y)
 
-        if mouse.rbutton_pressed or key.vk == tcod.KEY_ESCAPE:
-            return (None, None) # Cancel if the player right-clicked or pressed Esc
+def monsters_in_range(max_range):
+    # Every visible monster within max_range, nearest first
+    return list(visible_monsters(max_range))
 
 
 def closest_monster(max_range):
-    # find closest enemy up to a max range and inside player's FOV
-    closest_enemy = None
-    closest_dist = max_range + 1 # Start with slightly more than max range
-
-    for object in objects:
-        if object.fighter and not object == player and tcod.map_is_in_fov(fov_map, object.x, object.y):
-            # Calculate distance between this object and the player
-            dist = player.distance_to(object)
-            if dist < closest_dist: # It's closer, so remember it
-                closest_enemy = object
-                closest_dist = dist
-    return closest_enemy
+    # Find the closest enemy inside the player's FOV up to a max range. As it always has, that takes in
+    # anything closer than max_range + 1: distances squared are whole numbers, so that is this distance
+    return nearest_monster(math.sqrt((max_range + 1) ** 2 - 1))
 
 
 def cast_fireball():
@@ -502,12 +2451,13 @@ def cast_fireball():
     add_message('Left-click a target tile for the fireball, or right-click to cancel.', tcod.light_cyan)
     (x, y) = target_tile()
     if x is None: return 'cancelled'
-    add_message('The fireball explodes, burning everything within ' + str(FIREBALL_RADIUS) + ' tiles!', tcod.orange)
+    add_message('The fireball explodes, burning everything within %d tiles!', tcod.orange, (FIREBALL_RADIUS,))
+    make_noise(x, y, FIREBALL_NOISE)
 
-    for obj in objects: # Damage every fighter in range, including the player
-        if obj.distance(x, y) <= FIREBALL_RADIUS and obj.fighter:
-            add_message('The ' + obj.name + ' gets burned for ' + str(FIREBALL_DAMAGE) + ' hit points.', tcod.orange)
-            obj.fighter.take_damage(FIREBALL_DAMAGE)
+    # Damage every fighter in range, including the player. The fireball has always gone through walls
+    for obj in fighters_in_area(x, y, disk_stencil(FIREBALL_RADIUS), walls_block=False):
+        add_message('The %s gets burned for %d hit points.', tcod.orange, (obj.name, FIREBALL_DAMAGE))
+        obj.fighter.take_damage(FIREBALL_DAMAGE)
 
 
 def cast_confuse():
@@ -520,7 +2470,7 @@ def cast_confuse():
     old_ai = monster.ai
     monster.ai = ConfusedMonster(old_ai)
     monster.ai.owner = monster # tell the ner component who owns it
-    add_message('The eyes of the ' + monster.name + ' look vacant. He starts to shamble around.', tcod.light_green)
+    add_message('The eyes of the %s look vacant. He starts to shamble around.', tcod.light_green, (monster.name,))
 
 
 def cast_lightning():
@@ -531,8 +2481,9 @@ def cast_lightning():
         return 'cancelled'
 
     # Zap it
-    add_message('A lightning bolt strikes the ' + monster.name + ' with a loud thunder! The damage is '
-                + str(LIGHTNING_DAMAGE) + ' hit points.', tcod.light_blue)
+    add_message('A lightning bolt strikes the %s with a loud thunder! The damage is %d hit points.', tcod.light_blue,
+                (monster.name, LIGHTNING_DAMAGE))
+    make_noise(monster.x, monster.y, LIGHTNING_NOISE)
     monster.fighter.take_damage(LIGHTNING_DAMAGE)
 
 
@@ -555,31 +2506,31 @@ def player_death(player):
     # For added effect, transform player into corpse
     player.char = '%'
     player.colour = tcod.dark_red
+    player.clear()
 
 
 def monster_death(monster):
     # Create monster corpse, doesn't block, can't be attacked, doesn't move
-    add_message(monster.name.capitalize() + ' dies screaming. You gain ' + str(monster.fighter.xp) + ' experience points.', tcod.grey)
+    add_message('%s dies screaming. You gain %d experience points.', tcod.grey, (monster.name.capitalize(), monster.fighter.xp))
     monster.char = '%'
     monster.colour = tcod.dark_red
     monster.blocks = False
+    monster.fighter.release()
     monster.fighter = None
     monster.ai = None
     monster.name = 'remains of a ' + monster.name
-    monster.send_to_back()
+    if monster.container is not None:
+        monster.container.revision += 1 # Its name changed
+    monster.send_to_back() # this also marks its tile for redrawing with the corpse
 
 
 def is_blocked(x, y):
     # First test the map tile
-    if map[x][y].blocked:
+    if map.is_blocked(x, y):
         return True
 
     # Now check for any blocking objects
-    for object in objects:
-        if object.blocks and object.x == x and object.y == y:
-            return True
-
-    return False
+    return objects.blocking_at(x, y)
 
 
 def place_objects(room):
@@ -604,15 +2555,15 @@ def place_objects(room):
     item_chances['shield'] = from_dungeon_level([[15, 4]])
 
     # Choose random number of monsters
-    num_monsters = tcod.random_get_int(0, 0, max_monsters)
+    num_monsters = rngs['spawn'].randint(0, max_monsters)
 
     for i in range(num_monsters):
         # Choose random spot for this monster
-        x = tcod.random_get_int(0, room.x1, room.x2)
-        y = tcod.random_get_int(0, room.y1, room.y2)
+        x = rngs['spawn'].randint(room.x1, room.x2)
+        y = rngs['spawn'].randint(room.y1, room.y2)
 
         if not is_blocked(x, y):
-            choice = random_choice(monster_chances)
+            choice = random_choice(monster_chances, rngs['spawn'])
             if choice == 'fascist':
                 # Create fascist
                 fighter_component = Fighter(hp=20, defense=0, power=4, xp=35, death_function=monster_death)
@@ -627,16 +2578,16 @@ def place_objects(room):
             objects.append(monster)
 
     # Choose random number of items
-    num_items = tcod.random_get_int(0, 0, max_items)
+    num_items = rngs['loot'].randint(0, max_items)
 
     for i in range(num_items):
         # Choose random spot for this item
-        x = tcod.random_get_int(0, room.x1+1, room.x2-1)
-        y = tcod.random_get_int(0, room.y1+1, room.y2-1)
+        x = rngs['loot'].randint(room.x1+1, room.x2-1)
+        y = rngs['loot'].randint(room.y1+1, room.y2-1)
 
         # Only place if tile is not blocked
         if not is_blocked(x, y):
-            choice = random_choice(item_chances)
+            choice = random_choice(item_chances, rngs['loot'])
             if choice == 'heal':
                 # Create a healing potion
                 item_component = Item(use_function=cast_heal)
@@ -673,47 +2624,43 @@ def place_objects(room):
 
 def create_room(room):
     global map
-    # Go through the tiles in the rectangle and make them passable
-    for x in range(room.x1 + 1, room.x2):
-        for y in range(room.y1 + 1, room.y2):
-            map[x][y].blocked = False
-            map[x][y].block_sight = False
+    # Make the tiles inside the rectangle passable (the border stays as wall)
+    map.carve(room.x1 + 1, room.y1 + 1, room.x2 - 1, room.y2 - 1)
 
 
-def make_map():
-    global map, objects, stairs
+def make_map(width=MAP_WIDTH, height=MAP_HEIGHT, max_rooms=MAX_ROOMS, level_world=None, spawn=True):
+    # Generate the current level, and return its rooms. In world mode it is carved into the map of
+    # level_world, which packs its objects away in batches, otherwise into a new Map. Without spawn the rooms
+    # are left empty (the benchmark times room placement on its own this way; the layout is the same)
+    global map, objects, stairs, upstairs
+
+    # Every level gets fresh random streams derived from the game seed, so it only depends on its depth
+    seed_level_rngs(dungeon_level)
 
     # The list of objects with just the player
-    objects = [player]
+    objects = ObjectList([player])
 
     # Fill map with "blocked" tiles
-    map = [
-        [Tile(True) for y in range(MAP_HEIGHT)]
-        for x in range(MAP_WIDTH)
-    ]
+    map = Map(width, height) if level_world is None else level_world.map
 
     rooms = []
+    room_index = RoomIndex()
     num_rooms = 0
+    randint = rngs['map'].randint # Rolled four times per room tried
 
-    for r in range(MAX_ROOMS):
+    for r in range(max_rooms):
         # Random width and height
-        w = tcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
-        h = tcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+        w = randint(ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+        h = randint(ROOM_MIN_SIZE, ROOM_MAX_SIZE)
         # Random position without going out og the boundaries of the map
-        x = tcod.random_get_int(0, 0, MAP_WIDTH - w - 1)
-        y = tcod.random_get_int(0, 0, MAP_HEIGHT - h - 1)
+        x = randint(0, width - w - 1)
+        y = randint(0, height - h - 1)
 
         # 'Rect' class makes rectangles easier to work with
         new_room = Rect(x, y, w, h)
 
-        # Run through the other rooms and see if they intersect with this one
-        failed = False
-        for other_room in rooms:
-            if new_room.intersect(other_room):
-                failed = True
-                break
-
-        if not failed:
+        # See if it intersects with any of the other rooms
+        if not room_index.intersects(new_room):
             # This means there are no intersections, so this room is valid
 
             # "Paint" it to the map's tiles
@@ -733,7 +2680,7 @@ def make_map():
                 (prev_x, prev_y) = rooms[num_rooms - 1].centre()
 
                 # Flip a coin
-                if tcod.random_get_int(0, 0, 1) == 1:
+                if randint(0, 1) == 1:
                     # First move horizontally, then vertically
                     create_h_tunnel(prev_x, new_x, prev_y)
                     create_v_tunnel(prev_y, new_y, new_x)
@@ -743,16 +2690,21 @@ def make_map():
                     create_h_tunnel(prev_x, new_x, prev_y)
 
             # add some contents to this room, such as monsters
-            place_objects(new_room)
+            if spawn:
+                place_objects(new_room)
+            if level_world is not None and len(objects) >= WORLD_SPAWN_BATCH:
+                objects = level_world.spawn_batch(objects)
 
             # Finally, append the new room to the list
             rooms.append(new_room)
+            room_index.add(new_room)
             num_rooms += 1
 
-            if SHOW_ROOM_NUMBERS and MAX_ROOMS <= 30:
+            if SHOW_ROOM_NUMBERS:
                 # optional: print "room number" to see how the map drawing worked
                 #          we may have more than ten rooms, so print 'A' for the first room, 'B' for the next...
-                room_no = Object(new_x, new_y, chr(64 + num_rooms), 'room number', tcod.white, always_visible=True)
+                label = ROOM_LABELS[(num_rooms - 1) % len(ROOM_LABELS)]
+                room_no = Object(new_x, new_y, label, 'room number', tcod.white, always_visible=True)
                 objects.insert(0, room_no)  # draw early, so monsters are drawn on top
 
     # Create staris at the centre of the last room
@@ -760,20 +2712,26 @@ def make_map():
     objects.append(stairs)
     stairs.send_to_back() # so it's drawn below creatures
 
+    # Below the first level, stairs back up where the player arrives
+    upstairs = None
+    if dungeon_level > 1:
+        (x, y) = rooms[0].centre()
+        upstairs = Object(x, y, '<', 'up stairs', tcod.white, always_visible=True)
+        objects.append(upstairs)
+        upstairs.send_to_back()
+
+    return rooms
+
 
 def create_h_tunnel(x1, x2, y):
     global map
-    for x in range(min(x1, x2), max(x1, x2) + 1):
-        map[x][y].blocked = False
-        map[x][y].block_sight = False
+    map.carve_h(x1, x2, y)
 
 
 def create_v_tunnel(y1, y2, x):
     global map
     # vertical tunnel
-    for y in range(min(y1, y2), max(y1, y2) + 1):
-        map[x][y].blocked = False
-        map[x][y].block_sight = False
+    map.carve_v(y1, y2, x)
 
 
 def inventory_menu(header):
@@ -791,9 +2749,9 @@ def inventory_menu(header):
 
     index = menu(header, options, INVENTORY_WIDTH)
 
-    # if an item was chosen, return it
+    # if an item was chosen, return its index in the inventory
     if index is None or len(inventory) == 0: return None
-    return inventory[index].item
+    return index
 
 
 def menu(header, options, width):
@@ -827,15 +2785,16 @@ def menu(header, options, width):
     x = SCREEN_WIDTH//2 - width//2
     y = SCREEN_HEIGHT//2 - height//2
     tcod.console_blit(window, 0, 0, width, height, 0, x, y, 1.0, 0.7)
+    gui_panel.on_screen = False # The menu may cover part of the panel
 
     # Compute x and y offsets to convert console position to menu position
     x_offset = x # x is the Left edge of the menu
     y_offset = y + header_height # Subtract the height of the header from the top edge of the menu
 
     while True:
-        # Present the root console to the player and check for input
+        # Present the root console to the player and wait for input
         tcod.console_flush()
-        tcod.sys_check_for_event(tcod.EVENT_KEY_PRESS|tcod.EVENT_MOUSE, key, mouse)
+        read_input(wait=True)
 
         if mouse.lbutton_pressed:
             (menu_x, menu_y) = (mouse.cx - x_offset, mouse.cy - y_offset)
@@ -857,6 +2816,278 @@ def menu(header, options, width):
         if index >= 0 and index <= 26: return None
 
 
+def update_fov():
+    # Recompute FOV if needed (the player moved or something), and explore everything visible.
+    # This is game logic rather than rendering: monsters act on what the player can see.
+    # Results are cached by position, radius and map revision, so backtracking costs no FOV computation
+    global fov_recompute, fov_visible, fov_visible_box, fov_revision, fov_key
+    if not fov_recompute:
+        return
+    fov_recompute = False
+
+    key = (player.x, player.y, TORCH_RADIUS, map.revision)
+    if key == fov_key: # Still standing in the same place (e.g. the move was blocked): nothing changed
+        return
+    box = fov_box()
+    window = fov_cache.get(key)
+    if window is None:
+        fov_cache_stats['misses'] += 1
+        tcod.map_compute_fov(fov_map, player.x, player.y, TORCH_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
+        window = compute_fov_window(box)
+        fov_cache[key] = window
+        if len(fov_cache) > FOV_CACHE_SIZE:
+            fov_cache.popitem(last=False) # Evict the least recently used result
+    else:
+        fov_cache_stats['hits'] += 1
+        fov_cache.move_to_end(key)
+
+    fov_key = key
+    fov_visible = expand_fov_window(window, box)
+    fov_visible_box = box
+    fov_revision += 1
+    map.explored[:] = _or_planes(map.explored, fov_visible)
+
+
+def compute_fov_window(box):
+    # Read the FOV computed by libtcod inside the box (nothing beyond the torch radius can be lit),
+    # as bytes with one row of the box after another
+    (x0, y0, x1, y1) = box
+    window = bytearray((x1 - x0 + 1) * (y1 - y0 + 1))
+    i = 0
+    for y in range(y0, y1 + 1):
+        for x in range(x0, x1 + 1):
+            if tcod.map_is_in_fov(fov_map, x, y):
+                window[i] = 1
+            i += 1
+    return bytes(window)
+
+
+def expand_fov_window(window, box):
+    # Turn an FOV window back into a byte plane covering the whole map (1 = visible)
+    (x0, y0, x1, y1) = box
+    width = x1 - x0 + 1
+    visible = bytearray(map.width * map.height)
+    for y in range(y0, y1 + 1):
+        start = y * map.width + x0
+        visible[start:start + width] = window[(y - y0) * width:(y - y0 + 1) * width]
+    return visible
+
+
+def is_in_fov(x, y):
+    # Return True if the tile is currently visible to the player
+    if 0 <= x < map.width and 0 <= y < map.height:
+        return fov_visible[y * map.width + x] == 1
+    return False
+
+
+def player_distance_field():
+    # The distance field towards the player, brought up to date if the player moved since it was computed
+    player_field.update(player.x, player.y)
+    return player_field
+
+
+def set_terrain(x, y, blocked, block_sight=None):
+    # Open or close a tile during play (a door, a collapsing wall...), keeping FOV and the screen up to date
+    global fov_recompute
+    map.set_tile(x, y, blocked, block_sight)
+    tcod.map_set_properties(fov_map, x, y, not map.block_sight[map.index(x, y)], not map.blocked[map.index(x, y)])
+    fov_recompute = True # The map revision changed, so cached FOV results no longer match
+    mark_dirty(x, y)
+
+
+def tile_palette():
+    # Return the (background, foreground, glyph) of each tile class,
+    # where class = wall + 2 * visible + 4 * explored (see _tile_classes)
+    unexplored = (tcod.black, tcod.black, ' ')
+    if TRADITIONAL_LOOK:
+        dark_ground, dark_wall = (colour_dark_ground, tcod.white, '.'), (colour_dark_wall, tcod.white, '#')
+        light_ground, light_wall = (colour_light_ground, tcod.white, '.'), (colour_light_wall, tcod.white, '#')
+    else:
+        dark_ground, dark_wall = (colour_dark_ground, tcod.black, ' '), (colour_dark_wall, tcod.black, ' ')
+        light_ground, light_wall = (colour_light_ground, tcod.black, ' '), (colour_light_wall, tcod.black, ' ')
+    # Visible tiles are always explored, so classes 2 and 3 only show up if explored was reset
+    return [unexplored, unexplored, light_ground, light_wall, dark_ground, dark_wall, light_ground, light_wall]
+
+
+def palette_tables(palette):
+    # Turn the palette into bytes.translate tables: background r, g, b, foreground r, g, b and glyph
+    tables = [bytearray(256) for i in range(7)]
+    for (tile_class, (back, fore, char)) in enumerate(palette):
+        for (table, value) in zip(tables, (back.r, back.g, back.b, fore.r, fore.g, fore.b, ord(char))):
+            table[tile_class] = value
+    return [bytes(table) for table in tables]
+
+
+def camera():
+    # The map tile shown in the top-left corner of the screen. A map bigger than the screen (a world region)
+    # scrolls to keep the player in the middle; a normal level is always shown from (0, 0)
+    return (max(0, min(player.x - MAP_WIDTH // 2, map.width - MAP_WIDTH)),
+            max(0, min(player.y - MAP_HEIGHT // 2, map.height - MAP_HEIGHT)))
+
+
+def fov_box():
+    # Return the (x0, y0, x1, y1) box outside of which nothing can be in FOV
+    if TORCH_RADIUS > 0:
+        return (max(0, player.x - TORCH_RADIUS), max(0, player.y - TORCH_RADIUS),
+                min(map.width - 1, player.x + TORCH_RADIUS), min(map.height - 1, player.y + TORCH_RADIUS))
+    return (0, 0, map.width - 1, map.height - 1) # A radius of 0 means the light is unlimited
+
+
+def render_map(classes):
+    # Composite the whole map into con with one bulk call per channel. The tile classes are looked
+    # up in the palette with bytes.translate, so no Python code runs per tile
+    tables = palette_tables(tile_palette())
+    (back_r, back_g, back_b, fore_r, fore_g, fore_b, chars) = [list(classes.translate(table)) for table in tables]
+
+    tcod.console_fill_background(con, back_r, back_g, back_b)
+    if TRADITIONAL_LOOK:
+        tcod.console_fill_foreground(con, fore_r, fore_g, fore_b)
+        tcod.console_fill_char(con, chars)
+
+
+def mark_dirty(x, y):
+    # Remember that the tile at (x, y) has to be repainted (tile and objects) on the next render
+    dirty_cells.add((x, y))
+
+
+def mark_changed_tiles(old_classes, new_classes, box):
+    # Mark dirty every tile in the box whose class changed. Rows that are unchanged are skipped
+    # with a single slice comparison
+    (x0, y0, x1, y1) = box
+    for y in range(y0, y1 + 1):
+        start = y * map.width
+        if old_classes[start + x0:start + x1 + 1] == new_classes[start + x0:start + x1 + 1]:
+            continue
+        for x in range(x0, x1 + 1):
+            if old_classes[start + x] != new_classes[start + x]:
+                dirty_cells.add((x, y))
+
+
+def render_dirty_tiles():
+    # Repaint only the tiles that changed since the last frame
+    if not dirty_cells:
+        return
+
+    palette = tile_palette()
+    for (x, y) in dirty_cells:
+        if 0 <= x < map.width and 0 <= y < map.height:
+            (back, fore, char) = palette[tile_classes[map.index(x, y)]]
+            tcod.console_put_char_ex(con, x, y, char, fore, back)
+
+
+def render_dirty_objects():
+    # Draw the objects standing on the tiles that were repainted, the player last
+    global dirty_cells
+    if not dirty_cells:
+        return
+
+    for (x, y) in dirty_cells:
+        if 0 <= x < map.width and 0 <= y < map.height:
+            for object in objects.at(x, y):
+                if object != player:
+                    object.draw()
+    if (player.x, player.y) in dirty_cells:
+        player.draw()
+
+    dirty_cells = set()
+
+
+class Widget:
+    # One part of the GUI panel, which stays drawn on the panel console between frames. key() is cheap and
+    # changes whenever what the widget shows may have changed; only then is value() worked out, and only a
+    # different value is drawn. Each widget owns a rectangle of the panel, cleared before it is redrawn
+    __slots__ = ('rect', 'draw', 'value', 'key', 'shown_key', 'shown')
+
+    def __init__(self, rect, draw, value, key=None):
+        self.rect = rect # (x, y, width, height)
+        self.draw = draw # draw(x, y, width, value)
+        self.value = value
+        self.key = key or value
+        self.invalidate()
+
+    def invalidate(self):
+        self.shown_key = self.shown = None
+
+    def update(self):
+        # Redraw the widget if its value changed. Return True if it was redrawn
+        key = self.key()
+        if key == self.shown_key:
+            return False
+        self.shown_key = key
+        value = key if self.key is self.value else self.value()
+        if value == self.shown:
+            return False
+        self.shown = value
+
+        (x, y, width, height) = self.rect
+        tcod.console_set_default_background(panel, tcod.black)
+        tcod.console_rect(panel, x, y, width, height, True, tcod.BKGND_SET)
+        self.draw(x, y, width, value)
+        return True
+
+
+class GuiPanel:
+    # The widgets of the GUI panel. The panel is only blitted to the screen when a widget was redrawn,
+    # or after something else was drawn over it (a menu), so an idle frame does next to no panel work
+    def __init__(self, widgets):
+        self.widgets = widgets
+        self.on_screen = False
+
+    def invalidate(self):
+        # Redraw every widget on the next render, e.g. for a new level or a loaded game
+        tcod.console_set_default_background(panel, tcod.black)
+        tcod.console_clear(panel)
+        for widget in self.widgets:
+            widget.invalidate()
+        self.on_screen = False
+
+    def render(self):
+        # Returns True if the panel was blitted
+        redrawn = False
+        for widget in self.widgets:
+            redrawn = widget.update() or redrawn
+        if redrawn or not self.on_screen:
+            tcod.console_blit(panel, 0, 0, SCREEN_WIDTH, PANEL_HEIGHT, 0, 0, PANEL_Y)
+            self.on_screen = True
+            return True
+        return False
+
+
+def draw_mouse_look(x, y, width, names):
+    tcod.console_set_default_foreground(panel, tcod.light_grey)
+    tcod.console_print_ex(panel, x + 1, y, tcod.BKGND_NONE, tcod.LEFT, names)
+
+
+def draw_messages(x, y, width, lines):
+    # Print the last messages, one line at a time, each with its own colour
+    for (i, (text, colour)) in enumerate(lines):
+        tcod.console_set_default_foreground(panel, colour)
+        tcod.console_print_ex(panel, x, y + i, tcod.BKGND_NONE, tcod.LEFT, text)
+
+
+def draw_hp_bar(x, y, width, hp):
+    render_bar(x, y, width, 'HP', hp[0], hp[1], tcod.light_red, tcod.darker_red)
+
+
+def draw_dungeon_level(x, y, width, level):
+    tcod.console_set_default_foreground(panel, tcod.white)
+    tcod.console_print_ex(panel, x, y, tcod.BKGND_NONE, tcod.LEFT, 'Dungeon level ' + str(level))
+
+
+def make_gui_panel():
+    # The mouse-look line at the top, the HP bar and dungeon level on the left and the messages on the right.
+    # What is under the mouse can only change when the mouse, the camera or the FOV moves, or an object
+    # is added, removed, moved or renamed (see ObjectList.revision)
+    return GuiPanel([
+        Widget((0, 0, SCREEN_WIDTH, 1), draw_mouse_look, get_names_under_mouse,
+               key=lambda: (mouse.cx, mouse.cy, camera(), fov_revision, objects.revision)),
+        Widget((MSG_X, 1, SCREEN_WIDTH - MSG_X, MSG_HEIGHT), draw_messages,
+               lambda: game_msgs.lines(MSG_HEIGHT, MSG_WIDTH), key=lambda: game_msgs.revision),
+        Widget((1, 1, BAR_WIDTH, 1), draw_hp_bar, lambda: (player.fighter.hp, player.fighter.max_hp)),
+        Widget((1, 3, BAR_WIDTH, 1), draw_dungeon_level, lambda: dungeon_level),
+    ])
+
+
 def render_bar(x, y, total_width, name, value, maximum, bar_colour, back_colour):
     # Render a bar (HP, exp., etc). First calculate the width of the bar
     bar_width = int(float(value) / maximum * total_width)
@@ -877,87 +3108,63 @@ def render_bar(x, y, total_width, name, value, maximum, bar_colour, back_colour)
 
 
 def render_all():
-    global colour_dark_wall, colour_light_wall
-    global colour_dark_ground, colour_light_ground
-    global fov_map, fov_recompute, dungeon_level
-
-    if fov_recompute:
-        # Recompute FOV if needed (the player moved or something)
-        fov_recompute = False
-        tcod.map_compute_fov(fov_map, player.x, player.y, TORCH_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
-
-        # Go through all tiles and set background colour according to FOV
-        for y in range(MAP_HEIGHT):
-            for x in range(MAP_WIDTH):
-                visible = tcod.map_is_in_fov(fov_map, x, y)
-                wall = map[x][y].block_sight
-                if not visible:
-                    # if it's not visible right now, the player can only see it if it's explored
-                    if map[x][y].explored:
-                        if wall:
-                            if TRADITIONAL_LOOK:
-                                tcod.console_put_char_ex(con, x, y, '#', tcod.white, colour_dark_wall)
-                            else:
-                                tcod.console_set_char_background(con, x, y, colour_dark_wall, tcod.BKGND_SET)
-                        else:
-                            if TRADITIONAL_LOOK:
-                                tcod.console_put_char_ex(con, x, y, '.', tcod.white, colour_dark_ground)
-                            else:
-                                tcod.console_set_char_background(con, x, y, colour_dark_ground, tcod.BKGND_SET)
-                else:
-                    if wall:
-                        if TRADITIONAL_LOOK:
-                            tcod.console_put_char_ex(con, x, y, '#', tcod.white, colour_light_wall)
-                        else:
-                            tcod.console_set_char_background(con, x, y, colour_light_wall, tcod.BKGND_SET)
-                    else:
-                        if TRADITIONAL_LOOK:
-                            tcod.console_put_char_ex(con, x, y, '.', tcod.white, colour_light_ground)
-                        else:
-                            tcod.console_set_char_background(con, x, y, colour_light_ground, tcod.BKGND_SET)
-                    # since it's visible, explore it
-                    map[x][y].explored = True
-
-    # Draw all objects in the list
-    for object in objects:
-        if object != player:
-            object.draw()
-    player.draw()
-
-    # Prepare to render the GUI panel
-    tcod.console_set_default_background(panel, tcod.black)
-    tcod.console_clear(panel)
-
-    # Print the game messages, one line at a time
-    y = 1
-    for(line, colour) in game_msgs:
-        tcod.console_set_default_foreground(panel, colour)
-        tcod.console_print_ex(panel, MSG_X, y, tcod.BKGND_NONE, tcod.LEFT, line)
-        y += 1
-
-    # Show the player's stats and dungeon level
-    render_bar(1, 1, BAR_WIDTH, 'HP', player.fighter.hp, player.fighter.max_hp, tcod.light_red, tcod.darker_red)
-    tcod.console_print_ex(panel, 1, 3, tcod.BKGND_NONE, tcod.LEFT, 'Dungeon level ' + str(dungeon_level))
-
-    # Display the names of objects under the mouse
-    tcod.console_set_default_foreground(panel, tcod.light_grey)
-    tcod.console_print_ex(panel, 1, 0, tcod.BKGND_NONE, tcod.LEFT, get_names_under_mouse())
-
-    # Blit the contents of panel to the root console
-    tcod.console_blit(panel, 0, 0, SCREEN_WIDTH, PANEL_HEIGHT, 0, 0, PANEL_Y)
-
-    # Blit the contents of con to the root console
-    tcod.console_blit(con, 0, 0, SCREEN_WIDTH, SCREEN_HEIGHT, 0, 0, 0)
-
-
-#def get_key_event(turn_based = None):
-#    if turn_based:
-#        # Turn-based gameplay; wait for a keystroke
-#        key = tcod.console_wait_for_keypress(True)
-#    else:
-#        # Real-time gameplay; don't wait for a player's keystoke
-#        key = tcod.console_check_for_keypress()
-#    return key
+    global fov_map, dungeon_level
+    global tile_classes, last_fov_box, painted_fov_revision
+
+    update_fov()
+    if profiler:
+        profiler.lap('fov')
+
+    if tile_classes is None or painted_fov_revision != fov_revision:
+        painted_fov_revision = fov_revision
+        classes = _tile_classes(map.block_sight, fov_visible, map.explored)
+
+        if tile_classes is None:
+            # Nothing painted yet on this level: paint the whole map, then every object (on its dirty tile)
+            render_map(classes)
+            tile_classes = classes
+            dirty_cells.clear()
+            for object in objects:
+                dirty_cells.add((object.x, object.y))
+        else:
+            # Only tiles that were or are now within reach of the light can have changed
+            (x0, y0, x1, y1) = last_fov_box
+            box = fov_visible_box
+            mark_changed_tiles(tile_classes, classes, (min(x0, box[0]), min(y0, box[1]),
+                                                       max(x1, box[2]), max(y1, box[3])))
+            tile_classes = classes
+        last_fov_box = fov_visible_box
+
+    # Repaint the tiles that changed, then the objects on them
+    map_drawn = bool(dirty_cells)
+    render_dirty_tiles()
+    if profiler:
+        profiler.lap('tiles')
+    render_dirty_objects()
+    if profiler:
+        profiler.lap('objects')
+
+    # Redraw the GUI panel widgets whose values changed, and blit the panel if anything did
+    panel_drawn = gui_panel.render()
+    if profiler:
+        profiler.lap('panel')
+
+    # Blit the part of con the camera is looking at to the root console, if any of it was repainted. When the
+    # panel had to be blitted again (after a menu), so does the map
+    if map_drawn or panel_drawn:
+        (camera_x, camera_y) = camera()
+        tcod.console_blit(con, camera_x, camera_y, MAP_WIDTH, MAP_HEIGHT, 0, 0, 0)
+    if profiler:
+        profiler.lap('blit')
+    return map_drawn or panel_drawn # Whether the screen has to be presented again
+
+
+def read_input(wait):
+    # Read the next key press or mouse event into key and mouse. If wait is set, sleep until there is one,
+    # so the game uses no CPU while the player is thinking; otherwise only check for one (real-time play)
+    if wait:
+        return tcod.sys_wait_for_event(tcod.EVENT_KEY_PRESS | tcod.EVENT_MOUSE, key, mouse, False)
+    return tcod.sys_check_for_event(tcod.EVENT_KEY_PRESS | tcod.EVENT_MOUSE, key, mouse)
 
 
 def player_move_or_attack(dx, dy):
@@ -969,8 +3176,8 @@ def player_move_or_attack(dx, dy):
 
     # Try to find an attackable object there
     target = None
-    for object in objects:
-        if object.fighter and object.x == x and object.y == y:
+    for object in objects.at(x, y):
+        if object.fighter:
             target = object
             break
     # Attack if target found, move otherwise
@@ -981,90 +3188,172 @@ def player_move_or_attack(dx, dy):
         fov_recompute = True
 
 
-def add_message(new_msg, colour=tcod.white):
-    # Split the message if necessary, among multiple lines
-    new_msg_lines = textwrap.wrap(new_msg, MSG_WIDTH)
+class Message:
+    # One message of the log. Its text is only formatted when it is first needed, and its wrapped lines are
+    # kept for the last width (and numbering) they were wrapped to
+    __slots__ = ('template', 'args', 'colour', 'turn', 'formatted', 'wrapped_as', 'lines')
+
+    def __init__(self, template, args, colour, turn):
+        self.template = template
+        self.args = args
+        self.colour = colour
+        self.turn = turn
+        self.formatted = None
+        self.wrapped_as = None
+
+    @property
+    def text(self):
+        if self.formatted is None:
+            self.formatted = self.template % self.args if self.args else self.template
+        return self.formatted
+
+    def wrap(self, width, numbered=False):
+        # The lines of the message wrapped to width, starting with the turn number if numbered
+        if self.wrapped_as != (width, numbered):
+            text = ('%d: ' % self.turn if numbered else '') + self.text
+            self.lines = textwrap.wrap(text, width)
+            self.wrapped_as = (width, numbered)
+        return self.lines
+
+
+class MessageLog:
+    # The game's messages, oldest first, in a ring buffer that drops the oldest past MESSAGE_LOG_SIZE.
+    # Lines are worked out from the newest message back, only as far as they are needed
+    def __init__(self, size=MESSAGE_LOG_SIZE):
+        self.messages = collections.deque(maxlen=size)
+        self.revision = 0 # Bumped by every message, so the panel knows when to redraw
+
+    def __len__(self):
+        return len(self.messages)
+
+    def add(self, template, args, colour, turn):
+        self.messages.append(Message(template, args, colour, turn))
+        self.revision += 1
+
+    def lines(self, count, width, skip=0, numbered=False):
+        # Return up to count (text, colour) lines wrapped to width, oldest first: the last ones of the log,
+        # or, to scroll back, the ones before the newest skip lines
+        found = []
+        for message in reversed(self.messages):
+            for line in reversed(message.wrap(width, numbered)):
+                if skip > 0:
+                    skip -= 1
+                    continue
+                found.append((line, message.colour))
+                if len(found) == count:
+                    return found[::-1]
+        return found[::-1]
+
+
+def message_history():
+    # Show the message log on the whole screen, with turn numbers. Up/down scroll by a line, page up/down
+    # by a page, and any other key closes it
+    global key
+    (width, height) = (SCREEN_WIDTH - 2, SCREEN_HEIGHT - 2)
+    window = tcod.console_new(SCREEN_WIDTH, SCREEN_HEIGHT)
+    skip = 0
+    while True:
+        lines = game_msgs.lines(height, width, skip, numbered=True)
+        tcod.console_clear(window)
+        tcod.console_set_default_foreground(window, tcod.white)
+        tcod.console_print_ex(window, 1, 0, tcod.BKGND_NONE, tcod.LEFT,
+                              'Message log: %d messages. Arrows and page up/down to scroll' % len(game_msgs))
+        for (y, (text, colour)) in enumerate(lines):
+            tcod.console_set_default_foreground(window, colour)
+            tcod.console_print_ex(window, 1, y + 1 + height - len(lines), tcod.BKGND_NONE, tcod.LEFT, text)
+        tcod.console_blit(window, 0, 0, SCREEN_WIDTH, SCREEN_HEIGHT, 0, 0, 0)
+        tcod.console_flush()
+
+        key = tcod.console_wait_for_keypress(True)
+        step = {tcod.KEY_UP: 1, tcod.KEY_DOWN: -1, tcod.KEY_PAGEUP: height, tcod.KEY_PAGEDOWN: -height}.get(key.vk)
+        if step is None:
+            break
+        new_skip = max(0, skip + step)
+        if len(game_msgs.lines(height, width, new_skip, numbered=True)) == height or new_skip < skip:
+            skip = new_skip # Scroll, unless that would go past the oldest message
+    renderer.reset() # The map and panel have to be painted again
 
-    for line in new_msg_lines:
-        # If buffer is full, remove the first line to make room for the new one
-        if len(game_msgs) == MSG_HEIGHT:
-            del game_msgs[0]
 
-        # Add the new line as a tuple, with the text and the colour
-        game_msgs.append((line, colour))
+def add_message(new_msg, colour=tcod.white, args=()):
+    # Add a message to the log. new_msg can be a template filled in with args (new_msg % args), which is only
+    # done when the message is displayed, so a headless game never formats the combat messages
+    game_msgs.add(new_msg, args, colour, turn_count)
 
 
 def get_names_under_mouse():
     global mouse
 
     # Return a string with the names of all objects under the mouse
-    (x, y) = (mouse.cx, mouse.cy)
+    (camera_x, camera_y) = camera()
+    (x, y) = (mouse.cx + camera_x, mouse.cy + camera_y)
 
     # Create a list with the names of all objects at the mouse's coordinated and in FOV
-    names = [obj.name for obj in objects
-        if obj.x == x and obj.y == y and tcod.map_is_in_fov(fov_map, obj.x, obj.y)]
+    names = [obj.name for obj in objects.at(x, y) if is_in_fov(obj.x, obj.y)]
 
     names = ', '.join(names) # Join the names, separated by commas
     return names.capitalize()
 
 
 def handle_keys():
-    global fov_recompute
-    global game_state
+    # Translate the key that was pressed into a command for perform_command, or None.
+    # Keys that only concern the interface (full screen, menus, character screen) are dealt with here
     global key
 
-    #key = get_key_event(TURN_BASED)
-
     if key.vk == tcod.KEY_ENTER and key.lalt:
         # Alt+Enter: toggle full screen
         tcod.console_set_fullscreen(not tcod.console_is_fullscreen())
 
+    elif key.vk == tcod.KEY_F3:
+        # F3: show or hide the profiler's timings
+        toggle_profile_overlay()
+
     elif key.vk == tcod.KEY_ESCAPE:
-        return 'exit' # exit game
+        return ('exit',) # exit game
 
     if game_state == 'playing':
         #movement keys
         if key.vk == tcod.KEY_UP or key.vk == tcod.KEY_KP8:
-            player_move_or_attack(0, -1)
+            return ('move', 0, -1)
         elif key.vk == tcod.KEY_DOWN or key.vk == tcod.KEY_KP2:
-            player_move_or_attack(0, 1)
+            return ('move', 0, 1)
         elif key.vk == tcod.KEY_LEFT or key.vk == tcod.KEY_KP4:
-            player_move_or_attack(-1, 0)
+            return ('move', -1, 0)
         elif key.vk == tcod.KEY_RIGHT or key.vk == tcod.KEY_KP6:
-            player_move_or_attack(1, 0)
+            return ('move', 1, 0)
         elif key.vk == tcod.KEY_HOME or key.vk == tcod.KEY_KP7:
-            player_move_or_attack(-1, -1)
+            return ('move', -1, -1)
         elif key.vk == tcod.KEY_PAGEUP or key.vk == tcod.KEY_KP9:
-            player_move_or_attack(1, -1)
+            return ('move', 1, -1)
         elif key.vk == tcod.KEY_END or key.vk == tcod.KEY_KP1:
-            player_move_or_attack(-1, 1)
+            return ('move', -1, 1)
         elif key.vk == tcod.KEY_PAGEDOWN or key.vk == tcod.KEY_KP3:
-            player_move_or_attack(1, 1)
+            return ('move', 1, 1)
         elif key.vk == tcod.KEY_KP5:
-            pass  # Do nothing ie wait for the monster to come to you
+            return ('wait',)  # Do nothing ie wait for the monster to come to you
 
         else:
             # Test for other keys
             key_char = chr(key.c)
 
-            if key_char == ',':
+            if key_char == ',' and not key.shift: # shift+',' is '<', see below
                 # Pick up an item
-                for object in objects: # Look for item in the player's tile
-                    if object.x == player.x and object.y == player.y and object.item:
-                        object.item.pick_up()
-                        break
+                return ('pickup',)
 
             if key_char == 'i':
                 # Show the inventory
                 chosen_item = inventory_menu('Press the key next to an item to use it, of any other key to cancel.\n')
                 if chosen_item is not None:
-                    chosen_item.use()
+                    return ('use', chosen_item)
 
             if key_char == 'd':
                 # Show the inventory; if an item is selected, drop it
                 chosen_item = inventory_menu('Press the key next to an item to drop it, or any other to cancel.\n')
                 if chosen_item is not None:
-                    chosen_item.drop()
+                    return ('drop', chosen_item)
+
+            if key_char == 'm':
+                # Show the message log
+                message_history()
 
             if key.shift and key_char == 'c':
                 # Show character info
@@ -1075,32 +3364,245 @@ def handle_keys():
 
             if key.shift and key_char == '.':
                 # Go down the stairs, if the player is on them
-                if stairs.x == player.x and stairs.y == player.y:
-                    next_level()
+                return ('descend',)
+
+            if key.shift and key_char == ',':
+                # Go up the stairs, if the player is on them
+                return ('ascend',)
 
             if key_char == '.':
-                return  # Do nothing ie wait for the monster to come to you
+                return ('wait',)  # Do nothing ie wait for the monster to come to you
 
-            return 'didnt-take-turn'
+    return None
+
+
+class Profiler:
+    # Times the phases of the main loop (polling, FOV, tiles, objects, panel, flush, the player's action,
+    # the AI pass) and each monster's turn. The last PROFILE_SAMPLES timings of each phase are kept for
+    # percentiles and, when tracing, every timing as a Chrome trace event. Phases are timed with lap(), which
+    # records the time since the previous lap, so each phase costs one perf_counter call.
+    # Profiling is off when the module's profiler is None, and every timing point is then a single check
+    def __init__(self, trace=False, overlay=False, temporary=False):
+        self.samples = collections.defaultdict(lambda: collections.deque(maxlen=PROFILE_SAMPLES))
+        self.events = collections.deque(maxlen=PROFILE_TRACE_EVENTS) if trace else None
+        self.overlay = overlay
+        self.temporary = temporary # Only started for the overlay, see toggle_profile_overlay
+        self.overlay_lines = []
+        self.overlay_time = 0
+        self.origin = self.last = time.perf_counter()
+        self.frame_start = None
+
+    def record(self, phase, started, args=None):
+        # Record a phase that started at the time started (from time.perf_counter) and ends now
+        now = time.perf_counter()
+        self.samples[phase].append(now - started)
+        if self.events is not None:
+            event = {'name': phase, 'ph': 'X', 'pid': 1, 'tid': 1,
+                     'ts': (started - self.origin) * 1e6, 'dur': (now - started) * 1e6}
+            if args:
+                event['args'] = args
+            self.events.append(event)
+        self.last = now
+        return now
+
+    def lap(self, phase):
+        # Record a phase that started where the last one ended
+        self.record(phase, self.last)
+
+    def frame(self):
+        # End the frame that is being timed (if any) and start the next one
+        if self.frame_start is None:
+            self.frame_start = self.last = time.perf_counter()
+        else:
+            self.last = self.frame_start
+            self.frame_start = self.record('frame', self.frame_start)
+
+    def percentiles(self, phase, points=(50, 95, 99)):
+        # The given percentiles of the phase's recent timings, in seconds
+        ordered = sorted(self.samples[phase])
+        return [ordered[min(len(ordered) - 1, len(ordered) * point // 100)] for point in points]
+
+    def report(self):
+        # The phases timed, those that took most of the time first, as lines of text (in milliseconds)
+        lines = ['%-18s %7s %8s %8s %8s %8s' % ('phase', 'n', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms')]
+        for phase in sorted(self.samples, key=lambda phase: -sum(self.samples[phase])):
+            timings = self.samples[phase]
+            lines.append('%-18s %7d %8.3f %8.3f %8.3f %8.3f' % (
+                (phase[:18], len(timings)) + tuple(1000 * t for t in self.percentiles(phase)) +
+                (1000 * max(timings),)))
+        return lines
+
+    def write_trace(self, path):
+        # Write the timings to a JSON file in the Chrome trace format (for chrome://tracing or Perfetto),
+        # with the percentiles of each phase in otherData
+        trace = {'traceEvents': list(self.events or ()), 'displayTimeUnit': 'ms',
+                 'otherData': {phase: dict(zip(('p50', 'p95', 'p99'), self.percentiles(phase)))
+                               for phase in self.samples}}
+        with open(path, 'w') as file:
+            json.dump(trace, file)
+
+    def draw_overlay(self):
+        # Draw the report in a box on the top right of the map. It is worked out again twice a second,
+        # not every frame, as sorting the timings isn't free
+        now = time.perf_counter()
+        if now - self.overlay_time > PROFILE_OVERLAY_INTERVAL:
+            self.overlay_lines = [line[:18] + line[26:44] for line in self.report()[:MAP_HEIGHT - 2]]
+            self.overlay_time = now
+        width = max(len(line) for line in self.overlay_lines) + 2 if self.overlay_lines else 0
+        x = SCREEN_WIDTH - width - 1
+        tcod.console_set_default_background(0, tcod.black)
+        tcod.console_rect(0, x, 1, width, len(self.overlay_lines), True, tcod.BKGND_SET)
+        tcod.console_set_default_foreground(0, tcod.light_green)
+        for (y, line) in enumerate(self.overlay_lines):
+            tcod.console_print_ex(0, x + 1, y + 1, tcod.BKGND_NONE, tcod.LEFT, line)
+
+
+def toggle_profile_overlay():
+    # Show or hide the profiler overlay. Showing it starts profiling if it was off, and hiding it stops
+    # profiling again, unless it was asked for on the command line
+    global profiler
+    if profiler is None:
+        profiler = Profiler(overlay=True, temporary=True)
+    elif profiler.overlay and profiler.temporary:
+        profiler = None
+    else:
+        profiler.overlay = not profiler.overlay
+    gui_panel.on_screen = False # Blit the map and panel again, over the overlay
+
+
+def can_sleep(monster):
+    # A basic monster only does something when it is in FOV, so one out of sight and further than WAKE_RADIUS
+    # from the player can sleep (unless a noise woke it not long ago): it would be doing nothing anyway
+    if WAKE_RADIUS is None or type(monster.ai) is not BasicMonster or is_in_fov(monster.x, monster.y):
+        return False
+    if (monster.x - player.x) ** 2 + (monster.y - player.y) ** 2 <= WAKE_RADIUS ** 2:
+        return False
+    return objects.scheduler.time >= entities.actors.alert_until[monster.actor]
+
+
+def wake_monsters():
+    # Wake the sleeping monsters within WAKE_RADIUS of the player or in FOV, before the monsters' turn.
+    # Only the buckets of sleepers around the player and the lit area are looked at
+    if not objects.dormant:
+        return
+    (x, y) = (player.x, player.y)
+    nearby = objects.dormant.in_rect(x - WAKE_RADIUS, y - WAKE_RADIUS, x + WAKE_RADIUS, y + WAKE_RADIUS)
+    for monster in nearby + objects.dormant.in_rect(*fov_visible_box):
+        if monster in objects.dormant and ((monster.x - x) ** 2 + (monster.y - y) ** 2 <= WAKE_RADIUS ** 2 or
+                                           is_in_fov(monster.x, monster.y)):
+            objects.wake(monster)
+
+
+def make_noise(x, y, radius):
+    # Wake the sleeping monsters within radius of (x, y). They stay awake for NOISE_ALERT_TURNS, even far
+    # from the player
+    if not objects.dormant:
+        return
+    alert_until = objects.scheduler.time + NOISE_ALERT_TURNS * TURN_TIME
+    for monster in objects.dormant.in_rect(x - radius, y - radius, x + radius, y + radius):
+        if (monster.x - x) ** 2 + (monster.y - y) ** 2 <= radius ** 2:
+            objects.wake(monster)
+            entities.actors.alert_until[monster.actor] = alert_until
+
+
+def perform_command(command):
+    # Carry out a player command: ('move', dx, dy), ('wait',), ('pickup',), ('use', index), ('drop', index),
+    # ('descend',), ('ascend',) or ('exit',). Returns 'exit', 'didnt-take-turn', or None if the player took a turn
+    action = command[0]
+    if action == 'exit':
+        return 'exit'
+    if game_state != 'playing':
+        return 'didnt-take-turn'
+
+    if action == 'move':
+        player_move_or_attack(command[1], command[2])
+    elif action == 'wait':
+        pass
+    elif action == 'descend':
+        # Go down the stairs, if the player is on them (otherwise this is just a wait)
+        # Ask the index rather than compare coordinates: in world mode stairs outside the region keep
+        # their world coordinates
+        if any(obj is stairs for obj in objects.at(player.x, player.y)):
+            next_level()
+    elif action == 'ascend':
+        if upstairs and any(obj is upstairs for obj in objects.at(player.x, player.y)):
+            previous_level()
+    elif action == 'pickup':
+        for object in objects.at(player.x, player.y): # Look for item in the player's tile
+            if object.item:
+                object.item.pick_up()
+                break
+        return 'didnt-take-turn'
+    elif action in ('use', 'drop'):
+        if 0 <= command[1] < len(inventory):
+            if action == 'use':
+                inventory[command[1]].item.use()
+            else:
+                inventory[command[1]].item.drop()
+        return 'didnt-take-turn'
+    else:
+        return 'didnt-take-turn'
+
+
+def play_turn(command):
+    # Play one player command, then let the monsters act if it took a turn
+    global turn_count
+    player_action = perform_command(command)
+    if player_action == 'exit':
+        return 'exit'
+
+    if profiler:
+        profiler.lap('player')
+
+    if game_state == 'playing' and player_action != 'didnt-take-turn':
+        turn_count += 1
+        if world:
+            move_world_region()
+        update_fov() # Monsters see the player where they are now
+        if profiler:
+            profiler.lap('fov')
+            ai_start = profiler.last
+        wake_monsters()
+        for object in objects.scheduler.turn(): # The monsters due to act, see Scheduler
+            if can_sleep(object):
+                objects.sleep(object) # Until the player comes near or there's a noise, see wake_monsters
+            elif profiler:
+                (name, started) = (object.name, time.perf_counter())
+                object.ai.take_turn()
+                profiler.record('ai ' + name, started, {'id': id(object)})
+            else:
+                object.ai.take_turn()
+        if profiler:
+            profiler.record('ai', ai_start)
+
+    check_level_up()
+    return player_action
 
 
 def initialize_fov():
-    global fov_recompute, fov_map
+    global fov_recompute, fov_map, fov_key
     fov_recompute = True
+    fov_key = None
+    fov_cache.clear() # Cached results belong to the previous map
+    player_field.key = None
 
-    # Create the FOV map, according to the generated map
-    fov_map = tcod.map_new(MAP_WIDTH, MAP_HEIGHT)
-    for y in range(MAP_HEIGHT):
-        for x in range(MAP_WIDTH):
-            tcod.map_set_properties(fov_map, x, y, not map[x][y].block_sight, not map[x][y].blocked)
+    # Create the FOV map, according to the generated map. A new FOV map is all opaque and
+    # unwalkable, so only the tiles that were carved out need to be copied over
+    fov_map = tcod.map_new(map.width, map.height)
+    for (x, y, transparent, walkable) in map.open_cells():
+        tcod.map_set_properties(fov_map, x, y, transparent, walkable)
 
-    tcod.console_clear(con)  # Unexplored areas start black (which is the default background color)
+    renderer.reset() # Nothing is painted, so the next render repaints the whole map
 
 
-def new_game():
-    global player, inventory, game_msgs, game_state, dungeon_level
+def new_game(seed=None):
+    global player, inventory, game_msgs, game_state, dungeon_level, turn_count, game_seed, entities
 
+    # The whole game follows from this seed (and the player's commands)
+    game_seed = random.randrange(2 ** 32) if seed is None else seed
     dungeon_level = 1
+    turn_count = 0
+    entities = EntityStore() # Nothing of the previous game is used again
 
     # Create object representing the player
     fighter_component = Fighter(hp=30, defense=1, power=2, xp=0, death_function=player_death)
@@ -1109,11 +3611,13 @@ def new_game():
     player.level = 1
 
     # Generate map
-    make_map()
+    level_store.reset(game_seed)
+    make_level()
     initialize_fov()
+    request_next_level()
 
     game_state = 'playing'
-    game_msgs = []
+    game_msgs = MessageLog()
 
     # Welcome message
     add_message('Welcome stranger. Get ready to kick some imperialist butt!', tcod.grey)
@@ -1127,7 +3631,7 @@ def new_game():
 
 
 def initialize_game():
-    global fov_recompute, fov_map
+    global con, panel, renderer, user_input
 
     # Set up font
     font_path = 'arial10x10.png'
@@ -1141,42 +3645,49 @@ def initialize_game():
     # set FPS
     tcod.sys_set_fps(LIMIT_FPS)
 
-
-def play_game():
-    global key, mouse
-
-    exit_game = False
-    player_action = None
-
-    while not tcod.console_is_window_closed() and not exit_game:
-        tcod.sys_check_for_event(tcod.EVENT_KEY_PRESS | tcod.EVENT_MOUSE, key, mouse)
-        render_all()
-
-        tcod.console_flush()
-        check_level_up()
-
-        # Erase all objects at their old locations before they move
-        for object in objects:
-            object.clear()
-
-        # handle keys and exit game if needed
-        player_action = handle_keys()
-        if player_action == 'exit':
-            save_game()
-            break
-
-        if game_state == 'playing' and player_action != 'didnt-take-turn':
-            for object in objects:
-                if object.ai:
-                    object.ai.take_turn()
+    # Off-screen consoles for the map and the GUI panel, and the adapters that use the window
+    con = tcod.console_new(MAP_WIDTH, MAP_HEIGHT)
+    panel = tcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
+    renderer = TcodRenderer()
+    user_input = TcodInput()
+
+
+def play_game(max_commands=None, autosaver=None):
+    # Main loop: render, get a command from the input adapter and play it.
+    # Returns 'exit' if the player asked to leave the game
+    commands = 0
+    last_autosave = turn_count
+    while max_commands is None or commands < max_commands:
+        if profiler:
+            profiler.frame()
+        renderer.render()
+        renderer.flush()
+        if profiler:
+            profiler.lap('flush')
+
+        command = user_input.next_command()
+        if profiler:
+            profiler.lap('poll')
+        if command is None: # nothing was pressed this frame
+            continue
+        commands += 1
+
+        if play_turn(command) == 'exit':
+            return 'exit'
+
+        if autosaver and not world and game_state == 'playing' and turn_count - last_autosave >= AUTOSAVE_INTERVAL:
+            autosaver.save()
+            last_autosave = turn_count
 
 
 def msgbox(text, width=50):
     menu(text, [], width) # Use menu as a sort of 'message box'
 
 
-def main_menu():
+def main_menu(record_path=None):
+    global user_input
     img = tcod.image_load('menu_background.png')
+    autosaver = Autosaver()
 
     while not tcod.console_is_window_closed():
         # Show the background image, at twice the regular console resolution
@@ -1191,28 +3702,448 @@ def main_menu():
         choice = menu('', ['Play a new game', 'Continue last game', 'Quit'], 24)
 
         if choice == 0: # New game
+            if record_path:
+                user_input = RecordingInput(TcodInput())
             new_game()
-            play_game()
+            result = play_game(autosaver=autosaver)
+            if record_path:
+                save_replay(record_path, user_input.log)
+                user_input = TcodInput()
+            if result == 'exit' and not world: # World mode games aren't saved, the world is a scratch file
+                autosaver.wait() # so that an autosave still being written can't land after this save
+                save_game()
         elif choice == 1: # Load last game
             try:
                 load_game()
             except:
                 msgbox('\n No saved game to load.\n', 24)
                 continue
-            play_game()
+            if play_game(autosaver=autosaver) == 'exit':
+                autosaver.wait()
+                save_game()
         elif choice == 2: # Quit
             break
 
+    autosaver.wait()
+    return autosaver
+
+
+class TcodRenderer:
+    # Draws the game in the libtcod window. A frame is only presented if something was drawn in it
+    def __init__(self):
+        self.drawn = True
+
+    def render(self):
+        if render_all():
+            self.drawn = True
+        if profiler and profiler.overlay:
+            profiler.draw_overlay()
+            self.drawn = True
+
+    def flush(self):
+        # With nothing new to show, a turn-based game goes straight back to waiting for input, and a
+        # real-time one sleeps for a frame so that the loop doesn't spin faster than LIMIT_FPS
+        if self.drawn:
+            tcod.console_flush()
+            self.drawn = False
+        elif not TURN_BASED:
+            time.sleep(1 / LIMIT_FPS)
+
+    def reset(self):
+        # Forget what was painted, e.g. when a new level starts. con holds the whole map, so it is
+        # replaced when the map is a different size (in world mode)
+        global con, tile_classes
+        if (tcod.console_get_width(con), tcod.console_get_height(con)) != (map.width, map.height):
+            con = tcod.console_new(map.width, map.height)
+        tcod.console_clear(con)  # Unexplored areas start black (which is the default background color)
+        tile_classes = None
+        gui_panel.invalidate()
+
+
+class NullRenderer:
+    # Draws nothing, for headless runs
+    def render(self):
+        dirty_cells.clear()
+
+    def flush(self):
+        pass
+
+    def reset(self):
+        pass
+
+
+class TcodInput:
+    # Player input from the libtcod window: keyboard commands, menus and mouse targeting.
+    # Turn-based, it sleeps until there is a key press or mouse event. In real time, a turn passes every
+    # REALTIME_TURN seconds (a fixed time step): if the player hasn't done anything by then, they wait
+    def __init__(self):
+        self.next_turn = None
+
+    def next_command(self):
+        if tcod.console_is_window_closed():
+            return ('exit',)
+        read_input(TURN_BASED)
+        command = handle_keys()
+        if TURN_BASED:
+            return command
+
+        now = time.perf_counter()
+        if command is not None or self.next_turn is None:
+            self.next_turn = now + REALTIME_TURN
+        elif now >= self.next_turn:
+            command = ('wait',)
+            self.next_turn += REALTIME_TURN
+            if self.next_turn < now:
+                self.next_turn = now + REALTIME_TURN # Turns missed (e.g. in a menu) aren't caught up
+        return command
+
+    def choose_option(self, header, options, width):
+        return menu(header, options, width)
+
+    def choose_tile(self, max_range=None):
+        # Return the position of a tile left-clicked in player's FOV optionally in range, or None,None if right-clicked
+        while True:
+            # Render the screen, this erases the inventory and shows the names of objects under the mouse
+            render_all()
+            tcod.console_flush()
+            read_input(TURN_BASED)
+
+            (camera_x, camera_y) = camera()
+            (x, y) = (mouse.cx + camera_x, mouse.cy + camera_y)
+
+            if (mouse.lbutton_pressed and is_in_fov(x , y) and
+                    (max_range is None or player.distance(x, y) <= max_range)):
+                return(x, y)
+
+            if mouse.rbutton_pressed or key.vk == tcod.KEY_ESCAPE:
+                return (None, None) # Cancel if the player right-clicked or pressed Esc
+
+
+class ScriptedInput:
+    # Headless input: commands, menu choices and target tiles are all taken in order from one list.
+    # When the script runs out the player exits (and takes the first option of any menu still open)
+    def __init__(self, script):
+        self.script = iter(script)
+
+    def next_command(self):
+        return tuple(next(self.script, ('exit',)))
+
+    def choose_option(self, header, options, width):
+        return next(self.script, 0)
+
+    def choose_tile(self, max_range=None):
+        return tuple(next(self.script, (None, None)))
+
+
+class RecordingInput:
+    # Wraps another input adapter and logs every command and answer it gives, in order,
+    # so that a ScriptedInput can replay the session exactly
+    def __init__(self, source):
+        self.source = source
+        self.log = []
+
+    def next_command(self):
+        command = self.source.next_command()
+        if command is not None:
+            self.log.append(list(command))
+        return command
+
+    def choose_option(self, header, options, width):
+        choice = self.source.choose_option(header, options, width)
+        self.log.append(choice)
+        return choice
+
+    def choose_tile(self, max_range=None):
+        tile = self.source.choose_tile(max_range)
+        self.log.append(list(tile))
+        return tile
+
+
+class BotInput:
+    # Headless input that plays randomly, for simulations. Stops when the player dies
+    def __init__(self, seed=None):
+        self.rng = random.Random(seed)
+
+    def next_command(self):
+        if game_state != 'playing':
+            return ('exit',)
+        roll = self.rng.random()
+        if roll < 0.05 and inventory:
+            return ('use', self.rng.randrange(len(inventory)))
+        if roll < 0.1:
+            return ('pickup',)
+        if roll < 0.15:
+            return ('descend',)
+        if roll < 0.17:
+            return ('ascend',)
+        return ('move', self.rng.randint(-1, 1), self.rng.randint(-1, 1))
+
+    def choose_option(self, header, options, width):
+        return self.rng.randrange(len(options)) if options else None
+
+    def choose_tile(self, max_range=None):
+        # Aim at a random visible monster, if there is one in range
+        targets = [obj for obj in objects if obj.fighter and obj != player and
+                   is_in_fov(obj.x, obj.y) and
+                   (max_range is None or player.distance(obj.x, obj.y) <= max_range)]
+        if not targets:
+            return (None, None)
+        target = self.rng.choice(targets)
+        return (target.x, target.y)
+
+
+def simulate(games, max_commands, seed=None):
+    # Play games with no window, font or image, using BotInput. Returns (games, turns, seconds)
+    global renderer, user_input
+    renderer = NullRenderer()
+    rng = random.Random(seed)
+
+    turns = 0
+    start = time.perf_counter()
+    for game in range(games):
+        user_input = BotInput(rng.random())
+        new_game(rng.randrange(2 ** 32))
+        play_game(max_commands)
+        turns += turn_count
+    return (games, turns, time.perf_counter() - start)
+
+
+def benchmark_generation(sizes=MAPGEN_BENCHMARK_SIZES, seed=0):
+    # Time make_map on maps of each size, with as many rooms per tile as the normal map: once placing and
+    # carving the rooms only, then in full with the monsters and items. Returns (width, height, rooms tried,
+    # rooms placed, objects, seconds for the rooms, seconds in full) for each size
+    global game_seed, dungeon_level, player, entities
+    (game_seed, dungeon_level) = (seed, 1)
+    results = []
+    for (width, height) in sizes:
+        max_rooms = MAX_ROOMS * width * height // (MAP_WIDTH * MAP_HEIGHT)
+        entities = EntityStore() # The previous size's map is done with
+        player = Object(0, 0, '@', 'player', tcod.white, blocks=True)
+        start = time.perf_counter()
+        make_map(width, height, max_rooms, spawn=False)
+        rooms_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        rooms = make_map(width, height, max_rooms)
+        results.append((width, height, max_rooms, len(rooms), len(objects), rooms_seconds,
+                        time.perf_counter() - start))
+    return results
+
+
+def instance_size(obj):
+    # Shallow size of an instance, with its __dict__ if its class has one
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+
+def level_memory(level_map, level_objects, carried=()):
+    # Bytes used by a level (and the objects carried, if any), by class: (class name, count, bytes) sorted
+    # by bytes. Sizes are shallow, so things shared between objects (names, colours, functions) aren't counted
+    counts = collections.Counter()
+    sizes = collections.Counter()
+
+    def count(obj):
+        counts[type(obj).__name__] += 1
+        sizes[type(obj).__name__] += instance_size(obj)
+
+    for obj in list(level_objects) + list(carried):
+        count(obj)
+        ai = obj.ai
+        while ai is not None:
+            count(ai)
+            ai = getattr(ai, 'old_ai', None)
+        for component in (obj.fighter, obj.item, obj.equipment):
+            if component is not None:
+                count(component)
+    count(level_map)
+    if isinstance(level_map, Map):
+        sizes['Map'] += sum(sys.getsizeof(plane) for plane in (level_map.blocked, level_map.block_sight,
+                                                                level_map.explored))
+    if isinstance(level_objects, ObjectList):
+        count(level_objects)
+        sizes['ObjectList'] += sys.getsizeof(level_objects.cells) + sum(
+            sys.getsizeof(cell) for cell in level_objects.cells.values())
+    return sorted(((name, counts[name], sizes[name]) for name in counts), key=lambda entry: -entry[2])
+
+
+def memory_report():
+    # The memory used by the current level (with the inventory), each level kept in memory by the level
+    # store, and the rows of the entity store, as lines of text
+    levels = [('Level %d (current, with inventory)' % dungeon_level, map, objects, inventory)]
+    for (depth, level) in level_store.resident.items():
+        levels.append(('Level %d' % depth, level[0], level[1], []))
+
+    lines = []
+    for (title, level_map, level_objects, carried) in levels:
+        entries = level_memory(level_map, level_objects, carried)
+        lines.append('%s: %.1f KiB' % (title, sum(entry[2] for entry in entries) / 1024))
+        for (name, count, size) in entries:
+            lines.append('  %-16s %6d %10d bytes' % (name, count, size))
+    lines.append(entities.report())
+    return lines
+
+
+def state_digest():
+    # A hash of the whole game state, to check that a replay ends exactly where the recording did
+    digest = hashlib.sha1()
+    for plane in (map.blocked, map.block_sight, map.explored):
+        digest.update(plane)
+    for obj in list(objects) + inventory:
+        fighter = (obj.fighter.hp, obj.fighter.xp) if obj.fighter else None
+        digest.update(repr((obj.name, obj.x, obj.y, obj.char, fighter)).encode())
+    digest.update(repr((game_state, dungeon_level, turn_count, game_msgs.lines(MSG_HEIGHT, MSG_WIDTH))).encode())
+    return digest.hexdigest()
+
+
+def save_replay(path, log):
+    # Write an input log, with the seed it was played from and the state it ended in
+    with open(path, 'w') as file:
+        json.dump({'version': REPLAY_VERSION, 'seed': game_seed, 'world': world_size, 'digest': state_digest(),
+                   'log': log}, file)
+
+
+def replay(path):
+    # Replay an input log headless, as fast as possible. Returns (recorded digest, replayed digest, seconds)
+    global renderer, user_input, world_size
+    with open(path) as file:
+        recording = json.load(file)
+    if recording['version'] != REPLAY_VERSION:
+        raise ValueError('Unsupported replay version ' + str(recording['version']))
+
+    renderer = NullRenderer()
+    user_input = ScriptedInput(recording['log'])
+    world_size = tuple(recording['world']) if recording.get('world') else None
+    start = time.perf_counter()
+    new_game(recording['seed'])
+    play_game()
+    return (recording['digest'], state_digest(), time.perf_counter() - start)
+
 
 mouse = tcod.Mouse()
 key = tcod.Key()
 
+# Positions, fighter stats and AI state of every Object, see EntityStore
+entities = EntityStore()
+
+# Tiles that need repainting on the next render, see mark_dirty
+dirty_cells = set()
+
+# Where the game is drawn and where commands come from. Headless until initialize_game opens the window
+renderer = NullRenderer()
+gui_panel = make_gui_panel()
+user_input = ScriptedInput([])
+profiler = None # A Profiler when --profile, --trace or the overlay (F3) is on
+pregenerator = None # A LevelPregenerator when PREGENERATE_LEVELS is on in the interactive game
+world_size = WORLD_SIZE # Set by --world
+world = None # The World being played in world mode
+level_store = LevelStore() # The levels above and below that the player has left
+player = None # Until new_game or load_game
+upstairs = None
+
+# Cached FOV results (key -> FOV window, least recently used first) and counters, see update_fov
+fov_cache = collections.OrderedDict()
+fov_cache_stats = {'hits': 0, 'misses': 0}
+fov_revision = 0
+
+# Area effect shapes, by shape and size, see disk_stencil and cone_stencil
+stencils = {}
+
+# Shared by every monster chasing the player, see player_distance_field
+player_field = DistanceField(CHASE_DISTANCE)
+
+# The random streams of the current level, see seed_level_rngs
+game_seed = 0
+rngs = {}
+
+
+def parse_size(text):
+    # 'WIDTHxHEIGHT' -> (width, height), for --world
+    try:
+        (width, height) = [int(part) for part in text.lower().split('x')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected WIDTHxHEIGHT, e.g. 4000x4000')
+    if width < MAP_WIDTH or height < MAP_HEIGHT:
+        raise argparse.ArgumentTypeError('a world must be at least %dx%d' % (MAP_WIDTH, MAP_HEIGHT))
+    return (width, height)
+
+
+def report_profile(trace_path=None):
+    # Print the profiler's timings, if it was on, and write them to trace_path if given
+    if profiler is None:
+        return
+    print('\n'.join(profiler.report()))
+    if trace_path:
+        profiler.write_trace(trace_path)
+        print('Trace written to ' + trace_path)
+
 
 def main():
+    global pregenerator, world_size, profiler
+    parser = argparse.ArgumentParser(description='Fascist exterminators')
+    parser.add_argument('--headless', type=int, metavar='GAMES',
+                        help='simulate GAMES games with a random player and no window, and report the speed')
+    parser.add_argument('--commands', type=int, default=1000, help='maximum commands per simulated game')
+    parser.add_argument('--seed', type=int, help='seed for the simulated players and games')
+    parser.add_argument('--record', metavar='FILE', help='record new games to FILE, to be replayed with --replay')
+    parser.add_argument('--replay', metavar='FILE', help='replay a recorded game headless and check the result')
+    parser.add_argument('--benchmark-mapgen', action='store_true',
+                        help='time level generation on maps of increasing size and exit')
+    parser.add_argument('--world', type=parse_size, metavar='WIDTHxHEIGHT',
+                        help='play new games in world mode, on levels of this many tiles')
+    parser.add_argument('--memory-report', action='store_true',
+                        help='print the memory used by each level, by class, when the game ends')
+    parser.add_argument('--profile', action='store_true',
+                        help='time each phase of the game loop and each monster turn, and print percentiles at the end')
+    parser.add_argument('--trace', metavar='FILE', help='profile, and write the timings to FILE as a Chrome trace')
+    args = parser.parse_args()
+    if args.world:
+        world_size = args.world
+    if args.profile or args.trace:
+        profiler = Profiler(trace=bool(args.trace))
+
+    if args.benchmark_mapgen:
+        print('%11s %8s %8s %8s %8s %8s' % ('map', 'tried', 'rooms', 'objects', 'rooms s', 'total s'))
+        for (width, height, tried, placed, num_objects, rooms_seconds, seconds) in benchmark_generation(
+                seed=args.seed or 0):
+            print('%11s %8d %8d %8d %8.3f %8.3f' % ('%dx%d' % (width, height), tried, placed, num_objects,
+                                                    rooms_seconds, seconds))
+        return
+
+    if args.replay:
+        (recorded, replayed, seconds) = replay(args.replay)
+        print('Replayed in %.2fs: %s' % (seconds, 'identical' if recorded == replayed else 'MISMATCH'))
+        report_profile(args.trace)
+        return
+
+    if args.headless:
+        (games, turns, seconds) = simulate(args.headless, args.commands, args.seed)
+        print('%d games, %d turns in %.2fs (%.1f games/s, %.0f turns/s)' %
+              (games, turns, seconds, games / seconds, turns / seconds))
+        print('FOV cache: %(hits)d hits, %(misses)d misses' % fov_cache_stats)
+        if world:
+            print(world.report())
+        if args.memory_report:
+            print('\n'.join(memory_report()))
+        report_profile(args.trace)
+        return
 
     initialize_game()
-
-    main_menu()
-
-
-main()
+    if PREGENERATE_LEVELS:
+        pregenerator = LevelPregenerator()
+
+    autosaver = main_menu(args.record)
+    print(autosaver.report())
+    print(level_store.report())
+    if world:
+        print(world.report())
+    if args.memory_report and player is not None:
+        print('\n'.join(memory_report()))
+    report_profile(args.trace)
+    if pregenerator:
+        print(pregenerator.report())
+        pregenerator.shutdown()
+
+
+if __name__ == '__main__':
+    main()